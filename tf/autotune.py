@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import hashlib
+import json
+import os
+import socket
+import yaml
+from benchmark_utils import run_child, synthetic_batch
+
+# Training keys that change how much memory a step needs.
+MEMORY_KEYS = [
+    "precision", "optimizer", "new_optimizer", "checkpoint_activations",
+    "checkpoint_embedding_ffn", "swa", "shard_optimizer_state"
+]
+
+
+def cache_key(cfg, batch_size, num_replicas):
+    key = {
+        "model": cfg["model"],
+        "training": {k: cfg["training"].get(k)
+                     for k in MEMORY_KEYS},
+        "batch_size": batch_size,
+        "num_replicas": num_replicas,
+        "gpu": cfg.get("gpu", 0),
+        "host": socket.gethostname(),
+        "visible_devices": os.environ.get("CUDA_VISIBLE_DEVICES"),
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True,
+                                   default=str).encode()).hexdigest()
+
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(path, cache):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def count_gpus(result):
+    import tensorflow as tf
+    result.put(len(tf.config.list_physical_devices("GPU")))
+
+
+def probe(cfg, micro_batch, result):
+    """Run two full training steps of two micro-batches each on a single
+    device, so that accumulated gradients and optimizer slots exist."""
+    import tensorflow as tf
+    from tfprocess import TFProcess
+
+    tfp = TFProcess(cfg)
+    try:
+        tfp.init_net()
+        batch = [tf.constant(t) for t in synthetic_batch(micro_batch)]
+        for _ in range(2):
+            grads = None
+            for _ in range(2):
+                _, new_grads = tfp.process_inner_loop(*batch)
+                if tfp.shard_optimizer_state:
+                    tfp.accumulate_grads(new_grads)
+                elif grads is None:
+                    grads = new_grads
+                else:
+                    grads = tfp.merge_grads(grads, new_grads)
+            grad_norm, _ = tfp.apply_grads(grads, 2, False)
+            grad_norm.numpy()
+    except tf.errors.ResourceExhaustedError:
+        result.put(False)
+        return
+    result.put(True)
+
+
+def num_local_replicas(cfg):
+    gpu = cfg.get("gpu", 0)
+    if "," in str(gpu):
+        return len(str(gpu).split(","))
+    if gpu == "all" or cfg.get("cluster") is not None:
+        return max(1, run_child(count_gpus) or 0)
+    return 1
+
+
+def probe_cfg(cfg):
+    cfg = copy.deepcopy(cfg)
+    cfg.pop("cluster", None)
+    gpu = cfg.get("gpu", 0)
+    if "," in str(gpu):
+        cfg["gpu"] = int(str(gpu).split(",")[0])
+    elif gpu == "all":
+        cfg["gpu"] = 0
+    # Only the model and optimizer are built, no weights are restored.
+    cfg["training"].pop("pb_source", None)
+    return cfg
+
+
+def candidate_splits(batch_size, num_replicas):
+    return [
+        s for s in range(1, batch_size + 1) if batch_size % s == 0 and
+        (batch_size // s) % num_replicas == 0
+    ]
+
+
+def autotune_batch_splits(cfg, batch_size, use_cache=True, verbose=True):
+    """Smallest num_batch_splits for batch_size whose per-replica micro-batch
+    fits in memory, found by binary search over the valid splits. Every
+    probe builds the model in a new process. Results are cached in
+    training.autotune_cache."""
+    cache_path = cfg["training"].get("autotune_cache",
+                                     "autotune_cache.json")
+    num_replicas = num_local_replicas(cfg)
+    if cfg.get("cluster") is not None:
+        num_replicas *= len(cfg["cluster"]["workers"])
+    key = cache_key(cfg, batch_size, num_replicas)
+    cache = load_cache(cache_path)
+    if use_cache and key in cache:
+        if verbose:
+            print("Using cached num_batch_splits {} from {}".format(
+                cache[key]["batch_splits"], cache_path))
+        return cache[key]["batch_splits"]
+
+    splits = candidate_splits(batch_size, num_replicas)
+    if not splits:
+        raise ValueError(
+            "batch_size {} can't be split evenly over {} replicas".format(
+                batch_size, num_replicas))
+    pcfg = probe_cfg(cfg)
+    lo, hi = 0, len(splits) - 1
+    best = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        micro_batch = batch_size // splits[mid] // num_replicas
+        fits = bool(run_child(probe, pcfg, micro_batch))
+        if verbose:
+            print("Micro-batch {}: {}".format(micro_batch,
+                                              "fits" if fits else "too large"))
+        if fits:
+            best = mid
+            hi = mid - 1
+        else:
+            lo = mid + 1
+    if best is None:
+        raise ValueError(
+            "Even a micro-batch of {} does not fit, decrease the model dimension"
+            .format(batch_size // splits[-1] // num_replicas))
+
+    cache[key] = {
+        "name": cfg.get("name"),
+        "batch_size": batch_size,
+        "num_replicas": num_replicas,
+        "batch_splits": splits[best],
+        "micro_batch": batch_size // splits[best] // num_replicas,
+    }
+    save_cache(cache_path, cache)
+    if verbose:
+        print("Using num_batch_splits {} (micro-batch {} per replica)".format(
+            splits[best], cache[key]["micro_batch"]))
+    return splits[best]
+
+
+def main(cmd):
+    cfg = yaml.safe_load(cmd.cfg.read())
+    batch_size = cmd.batch_size or cfg["training"]["batch_size"]
+    autotune_batch_splits(cfg, batch_size, use_cache=not cmd.no_cache)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Find the num_batch_splits that fits a batch in memory.")
+    argparser.add_argument("--cfg",
+                           type=argparse.FileType("r"),
+                           help="yaml configuration with training parameters")
+    argparser.add_argument("--batch-size",
+                           type=int,
+                           help="batch size to tune for, default training.batch_size")
+    argparser.add_argument("--no-cache",
+                           action="store_true",
+                           help="probe even if a cached result exists")
+
+    main(argparser.parse_args())
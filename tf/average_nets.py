@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+from net import Net, decode_params
+
+
+def average_weights(count, mode="uniform", weights=None, decay=0.9):
+    """Weight of each of count nets, oldest first, summing to one."""
+    if mode == "uniform":
+        return [1.0 / count] * count
+    if mode == "ema":
+        # ema = decay * ema + (1 - decay) * net, starting from the first.
+        return [decay**(count - 1)] + [
+            (1 - decay) * decay**(count - 1 - i) for i in range(1, count)
+        ]
+    if mode == "weighted":
+        if weights is None or len(weights) != count:
+            raise ValueError("Need one weight per net, got {}".format(weights))
+        total = float(sum(weights))
+        return [w / total for w in weights]
+    raise ValueError("Unknown averaging mode: {}".format(mode))
+
+
+def average_nets(filenames, coefficients):
+    """Weighted sum of every layer of the nets. Nets are parsed one at a
+    time, so memory holds one net and the running sums. Returns the last
+    net, to be used as the template for the output, and the sums by
+    layer_index path."""
+    sums = None
+    net = None
+    for filename, coefficient in zip(filenames, coefficients):
+        net = Net()
+        net.parse_proto(filename)
+        index = net.layer_index()
+        if sums is None:
+            sums = {path: 0.0 for path in index}
+        elif set(index) != set(sums):
+            raise ValueError("{} has different layers than {}".format(
+                filename, filenames[0]))
+        for path, (params, min_val, max_val, encoding) in index.items():
+            w = decode_params(params, min_val, max_val, encoding)
+            if not np.isscalar(sums[path]) and sums[path].shape != w.shape:
+                raise ValueError("{} has {} values in {}, expected {}".format(
+                    filename, len(w), path, len(sums[path])))
+            sums[path] = sums[path] + coefficient * w.astype(np.float64)
+    return net, sums
+
+
+def main(cmd):
+    coefficients = average_weights(len(cmd.nets), cmd.mode, cmd.weights,
+                                   cmd.decay)
+    for filename, coefficient in zip(cmd.nets, coefficients):
+        print("{:.4f} {}".format(coefficient, filename))
+    net, sums = average_nets(cmd.nets, coefficients)
+
+    if cmd.weights_encoding is not None:
+        net.set_weights_encoding(cmd.weights_encoding)
+        net.pb.format.weights_encoding = net.weights_encoding
+    for path, w in sums.items():
+        net.fill_layer_v2(net.layer_at(path), w.astype(np.float32))
+    net.save_proto(cmd.output)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Average the weights of nets with the same architecture.")
+    argparser.add_argument("nets",
+                           type=str,
+                           nargs="+",
+                           help="net files, oldest first")
+    argparser.add_argument("--mode",
+                           type=str,
+                           default="uniform",
+                           help="uniform, ema or weighted")
+    argparser.add_argument("--weights",
+                           type=float,
+                           nargs="+",
+                           help="weight of each net for --mode weighted")
+    argparser.add_argument("--decay",
+                           type=float,
+                           default=0.9,
+                           help="decay of the older average for --mode ema")
+    argparser.add_argument("--weights-encoding",
+                           type=str,
+                           help="linear16, float16 or bfloat16, default the encoding of the last net")
+    argparser.add_argument("--output",
+                           type=str,
+                           required=True,
+                           help="file to store weights in")
+
+    main(argparser.parse_args())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+
+
+class BackgroundWorker:
+    """Runs submitted jobs in order on a single daemon thread.
+
+    At most `max_pending` jobs may be waiting; submit blocks beyond that so
+    that callers holding large host buffers cannot pile them up. An exception
+    raised by a job is re-raised on the next call to submit, wait or close.
+    """
+    def __init__(self, max_pending=1, name="background-worker"):
+        self.jobs = queue.Queue(maxsize=max(1, max_pending))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                if self.error is None:
+                    fn(*args, **kwargs)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, *args, **kwargs):
+        self._check()
+        self.jobs.put((fn, args, kwargs))
+
+    def wait(self):
+        """Block until every submitted job has finished."""
+        self.jobs.join()
+        self._check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        self._check()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import yaml
+import numpy as np
+from benchmark_utils import synthetic_planes, time_trials
+
+PRECISIONS = {
+    "single": ("float32", "float32"),
+    "half": ("mixed_float16", "float16"),
+    "bfloat16": ("mixed_bfloat16", "bfloat16"),
+}
+
+
+def build_model(tfp, precision):
+    import tensorflow as tf
+    policy, dtype = PRECISIONS[precision]
+    tf.keras.mixed_precision.set_global_policy(policy)
+    tfp.model_dtype = tf.as_dtype(dtype)
+    model = tfp.build_model()
+    tf.keras.mixed_precision.set_global_policy("float32")
+    return model
+
+
+def head_outputs(outputs):
+    return {
+        k: v
+        for k, v in outputs.items() if k not in ["attn_wts", "activations"]
+    }
+
+
+def drift(reference, outputs):
+    """Difference of each head's outputs from the float32 reference."""
+    result = {}
+    for k, ref in reference.items():
+        ref = ref.numpy()
+        out = outputs[k].numpy()
+        result[k] = {
+            "max_abs": float(np.max(np.abs(out - ref))),
+            "mean_abs": float(np.mean(np.abs(out - ref))),
+        }
+    if "policy" in reference:
+        result["policy"]["top1_agreement"] = float(
+            np.mean(
+                np.argmax(reference["policy"].numpy(), axis=1) == np.argmax(
+                    outputs["policy"].numpy(), axis=1)))
+    return result
+
+
+def main(cmd):
+    if cmd.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    import tensorflow as tf
+    from tfprocess import TFProcess
+
+    cfg = yaml.safe_load(cmd.cfg.read())
+    cfg.setdefault("gpu", 0)
+
+    tfp = TFProcess(cfg)
+    x = tf.constant(synthetic_planes(cmd.batch_size))
+
+    reference_model = build_model(tfp, "single")
+    reference = head_outputs(reference_model(x, training=False))
+
+    results = []
+    for precision in cmd.precisions.split(","):
+        model = build_model(tfp, precision)
+        model.set_weights(reference_model.get_weights())
+
+        forward = tf.function(lambda x: head_outputs(model(x, training=False)))
+
+        @tf.function
+        def train_step(x):
+            with tf.GradientTape() as tape:
+                outputs = head_outputs(model(x, training=True))
+                loss = tf.add_n([
+                    tf.reduce_mean(tf.cast(v, tf.float32))
+                    for v in outputs.values()
+                ])
+            return tape.gradient(loss, model.trainable_weights)
+
+        forward_time = time_trials(forward, (x, ), cmd.warmup, cmd.iters)[0]
+        train_time = time_trials(train_step, (x, ), cmd.warmup, cmd.iters)[0]
+        result = {
+            "precision": precision,
+            "forward_pos_per_s": cmd.batch_size / forward_time,
+            "train_pos_per_s": cmd.batch_size / train_time,
+            "drift": drift(reference, forward(x)),
+        }
+        results.append(result)
+        print("{}: forward {:.0f} pos/s, train {:.0f} pos/s".format(
+            precision, result["forward_pos_per_s"],
+            result["train_pos_per_s"]))
+        for k, d in result["drift"].items():
+            print("    {}: {}".format(
+                k, ", ".join("{}={:.3g}".format(n, v) for n, v in d.items())))
+
+    if cmd.output:
+        with open(cmd.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Compare throughput and numerical drift of precisions.")
+    argparser.add_argument("--cfg",
+                           type=argparse.FileType("r"),
+                           help="yaml configuration with model parameters")
+    argparser.add_argument("--precisions",
+                           type=str,
+                           default="single,bfloat16",
+                           help="comma separated list of single, half, bfloat16")
+    argparser.add_argument("--batch-size", type=int, default=64)
+    argparser.add_argument("--warmup", type=int, default=2)
+    argparser.add_argument("--iters", type=int, default=10)
+    argparser.add_argument("--cpu",
+                           action="store_true",
+                           help="hide GPUs and run on CPU")
+    argparser.add_argument("--output",
+                           type=str,
+                           help="write results as JSON to this file")
+
+    main(argparser.parse_args())
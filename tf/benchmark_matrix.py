@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import csv
+import itertools
+import json
+import os
+import resource
+import statistics
+import tempfile
+import yaml
+from benchmark_utils import run_child, synthetic_batch, time_trials
+
+# Knobs varied one at a time with --one-at-a-time when no --knob is given.
+DEFAULT_KNOBS = {
+    "model.use_rpe_q": [False, True],
+    "model.use_rpe_k": [False, True],
+    "model.use_rpe_v": [False, True],
+    "model.use_smolgen": [False, True],
+    "model.encoder_rms_norm": [False, True],
+    "model.omit_qkv_biases": [False, True],
+    "model.glu": [False, True],
+    "model.quantize_weights": [False, True],
+    "training.precision": ["single", "half", "bfloat16"],
+}
+PHASES = ["forward", "forward_backward", "optimizer"]
+
+
+def parse_knob(knob):
+    """model.use_smolgen=true,false -> ("model.use_smolgen", [True, False])"""
+    key, sep, values = knob.partition("=")
+    if not sep or "." not in key:
+        raise ValueError("Expected section.key=value,... got {}".format(knob))
+    return key, [yaml.safe_load(v) for v in values.split(",")]
+
+
+def set_knob(cfg, key, value):
+    section, name = key.split(".", 1)
+    cfg.setdefault(section, {})[name] = value
+
+
+def config_matrix(knobs, one_at_a_time=False):
+    """Knob settings to run, the cartesian product of the knob values, or
+    with one_at_a_time every value of each knob with the others left at the
+    base config."""
+    if one_at_a_time:
+        settings = [{}]
+        for key, values in knobs.items():
+            settings += [{key: value} for value in values]
+        return settings
+    keys = list(knobs)
+    return [
+        dict(zip(keys, values))
+        for values in itertools.product(*(knobs[key] for key in keys))
+    ]
+
+
+def peak_memory_mb():
+    """Peak device memory of the first GPU, None on CPU."""
+    import tensorflow as tf
+    if not tf.config.list_logical_devices("GPU"):
+        return None
+    return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2**20
+
+
+def run_config(cfg, batch_size, warmup, iters, trials, result):
+    """Time the parts of one training step, run through run_child."""
+    import tensorflow as tf
+    from tfprocess import TFProcess
+
+    try:
+        tfp = TFProcess(cfg)
+        tfp.init_net()
+        batch = [tf.constant(t) for t in synthetic_batch(batch_size)]
+
+        @tf.function
+        def forward(x):
+            return tfp.model(x, training=True)["policy"]
+
+        @tf.function
+        def optimizer_step(grads):
+            if tfp.shard_optimizer_state:
+                tfp.optimizer.accumulate(grads)
+            return tfp.apply_grads(grads, 1)[0]
+
+        if peak_memory_mb() is not None:
+            tf.config.experimental.reset_memory_stats("GPU:0")
+        # forward_backward is the training step with its real losses, timed
+        # as a whole rather than as a difference of separate runs.
+        phase_times = {
+            "forward":
+            time_trials(forward, batch[:1], warmup, iters, trials),
+            "forward_backward":
+            time_trials(tfp.process_inner_loop, batch, warmup, iters, trials),
+        }
+        _, grads = tfp.process_inner_loop(*batch)
+        # Pruned or frozen weights may have no gradient.
+        grads = [
+            tf.zeros_like(w) if g is None else g
+            for g, w in zip(grads, tfp.model.trainable_weights)
+        ]
+        phase_times["optimizer"] = time_trials(optimizer_step, (grads, ),
+                                               warmup, iters, trials)
+
+        row = {
+            "params": int(tfp.model.count_params()),
+            "peak_memory_mb": peak_memory_mb(),
+            # Kilobytes on Linux.
+            "max_rss_mb":
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        for phase in PHASES:
+            times = phase_times[phase]
+            row[phase + "_ms"] = 1000 * statistics.median(times)
+            row[phase + "_ms_min"] = 1000 * min(times)
+        row["step_ms"] = row["forward_backward_ms"] + row["optimizer_ms"]
+        row["train_pos_per_s"] = 1000 * batch_size / row["step_ms"]
+    except Exception as e:
+        # Some combinations are rejected by TFProcess, keep going.
+        row = {"error": "{}: {}".format(type(e).__name__, e)}
+    result.put(row)
+
+
+def main(cmd):
+    if cmd.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    base = yaml.safe_load(cmd.cfg.read())
+    # One device, no cluster, and checkpoints out of the way.
+    base["gpu"] = 0
+    base.pop("cluster", None)
+    base["training"]["path"] = tempfile.mkdtemp(prefix="benchmark-")
+
+    if cmd.knob:
+        knobs = dict(parse_knob(knob) for knob in cmd.knob)
+    else:
+        knobs = DEFAULT_KNOBS
+    results = []
+    for setting in config_matrix(knobs, cmd.one_at_a_time or not cmd.knob):
+        cfg = copy.deepcopy(base)
+        for key, value in setting.items():
+            set_knob(cfg, key, value)
+        label = ", ".join("{}={}".format(k, v)
+                          for k, v in setting.items()) or "base"
+        row = dict(setting)
+        # A fresh process per config, so the mixed precision policy and
+        # peak memory don't carry over.
+        row.update(
+            run_child(run_config, cfg, cmd.batch_size, cmd.warmup, cmd.iters,
+                      cmd.trials) or {"error": "crashed"})
+        if "error" in row:
+            print("{}: {}".format(label, row["error"]))
+        else:
+            print("{}: forward {:.2f} ms, forward+backward {:.2f} ms, "
+                  "optimizer {:.2f} ms, {:.0f} pos/s".format(
+                      label, row["forward_ms"], row["forward_backward_ms"],
+                      row["optimizer_ms"], row["train_pos_per_s"]))
+        results.append(row)
+
+    if cmd.output is None:
+        return
+    if cmd.output.endswith(".csv"):
+        columns = []
+        for row in results:
+            columns += [k for k in row if k not in columns]
+        with open(cmd.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(cmd.output, "w") as f:
+            json.dump(
+                {
+                    "batch_size": cmd.batch_size,
+                    "iters": cmd.iters,
+                    "trials": cmd.trials,
+                    "device": "cpu" if cmd.cpu else "gpu",
+                    "results": results,
+                },
+                f,
+                indent=2)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Time forward, backward and optimizer steps over a matrix of config knobs.")
+    argparser.add_argument("--cfg",
+                           type=argparse.FileType("r"),
+                           help="yaml configuration the knobs are applied to")
+    argparser.add_argument("--knob",
+                           type=str,
+                           action="append",
+                           help="section.key=value,... e.g. model.use_smolgen=false,true, "
+                           "repeat for a matrix of all combinations")
+    argparser.add_argument("--one-at-a-time",
+                           action="store_true",
+                           help="vary each knob alone from the base config, the default without --knob")
+    argparser.add_argument("--batch-size", type=int, default=64)
+    argparser.add_argument("--warmup", type=int, default=2)
+    argparser.add_argument("--iters", type=int, default=5)
+    argparser.add_argument("--trials", type=int, default=3)
+    argparser.add_argument("--cpu",
+                           action="store_true",
+                           help="hide GPUs and run on CPU")
+    argparser.add_argument("--output",
+                           type=str,
+                           help="write results to this .csv or .json file")
+
+    main(argparser.parse_args())
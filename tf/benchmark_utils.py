@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import multiprocessing as mp
+import queue
+import time
+import numpy as np
+
+
+def synthetic_planes(batch_size, seed=0):
+    """Random sparse 0/1 input planes shaped like a training batch."""
+    rng = np.random.default_rng(seed)
+    return (rng.random((batch_size, 112, 8, 8)) < 0.1).astype(np.float32)
+
+
+def synthetic_batch(batch_size, seed=0):
+    """Random inputs and targets shaped like a training batch, in the order
+    process_inner_loop takes them."""
+    planes = synthetic_planes(batch_size, seed)
+    probs = np.full((batch_size, 1858), 1 / 1858, dtype=np.float32)
+    wdl = np.full((batch_size, 3), 1 / 3, dtype=np.float32)
+    plies_left = np.full((batch_size, 1), 50, dtype=np.float32)
+    return planes, probs, wdl, wdl, plies_left, wdl, probs, probs
+
+
+def time_trials(fn, args, warmup, iters, trials=1):
+    """Seconds per call of fn(*args), one mean over iters calls per trial.
+    Waits for the device at the end of each trial."""
+    import tensorflow as tf
+    for _ in range(warmup):
+        out = fn(*args)
+    tf.nest.flatten(out)[0].numpy()
+    times = []
+    for _ in range(trials):
+        start = time.perf_counter()
+        for _ in range(iters):
+            out = fn(*args)
+        tf.nest.flatten(out)[0].numpy()
+        times.append((time.perf_counter() - start) / iters)
+    return times
+
+
+def run_child(target, *args):
+    """Run target(*args, result_queue) in a fresh process and return what it
+    put in the queue, None if it crashed. TF doesn't give memory back after
+    an OOM, and the global mixed precision policy and peak memory stats
+    don't carry over between runs."""
+    ctx = mp.get_context("spawn")
+    result = ctx.Queue()
+    process = ctx.Process(target=target, args=args + (result, ))
+    process.start()
+    process.join()
+    try:
+        return result.get(timeout=10)
+    except queue.Empty:
+        # Crashed, usually an allocation failure outside of TF's control.
+        return None
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import re
+import yaml
+import numpy as np
+from net import Net
+
+# Object graph entry of a variable's value in a TF2 checkpoint.
+VARIABLE_VALUE = "VARIABLE_VALUE"
+# Name of a tf.Variable created without one.
+ANONYMOUS_VARIABLE = re.compile(r"Variable(_\d+)?$")
+
+
+def checkpoint_prefix(path):
+    if os.path.isdir(path):
+        import tensorflow as tf
+        prefix = tf.train.latest_checkpoint(path)
+        if prefix is None:
+            raise ValueError("No checkpoint in {}".format(path))
+        return prefix
+    return path
+
+
+def read_checkpoint(path, swa=False):
+    """TF weight names to values and the global step of a TFProcess
+    checkpoint, read with the checkpoint reader and its object graph so that
+    no model has to be built. With swa, the SWA weights instead of the
+    model's."""
+    import tensorflow as tf
+    from tensorflow.core.protobuf import trackable_object_graph_pb2
+
+    reader = tf.train.load_checkpoint(checkpoint_prefix(path))
+    graph = trackable_object_graph_pb2.TrackableObjectGraph()
+    graph.ParseFromString(reader.get_tensor("_CHECKPOINTABLE_OBJECT_GRAPH"))
+    root = {c.local_name: c.node_id for c in graph.nodes[0].children}
+
+    def value(node_id):
+        for attribute in graph.nodes[node_id].attributes:
+            if attribute.name == VARIABLE_VALUE:
+                return attribute
+        return None
+
+    # The model's variables are everything reachable from its node, SWA
+    # weights are the list tracked as `listed`.
+    subtree = "listed" if swa else "model"
+    if subtree not in root:
+        raise ValueError("Checkpoint has no {} weights".format(
+            "SWA" if swa else "model"))
+    weights = {}
+    seen = set()
+    pending = [root[subtree]]
+    while pending:
+        node_id = pending.pop()
+        if node_id in seen:
+            continue
+        seen.add(node_id)
+        attribute = value(node_id)
+        if attribute is not None:
+            if ANONYMOUS_VARIABLE.match(attribute.full_name):
+                # Older checkpoints hold the SWA weights as unnamed copies
+                # of the model's, only their position says which is which.
+                raise ValueError(
+                    "{} weights of {} have no names, convert it with "
+                    "model_to_net.py instead".format(
+                        "SWA" if swa else "Model", path))
+            weights[attribute.full_name + ":0"] = reader.get_tensor(
+                attribute.checkpoint_key)
+        pending.extend(c.node_id for c in graph.nodes[node_id].children)
+
+    steps = None
+    if "global_step" in root:
+        steps = int(reader.get_tensor(value(root["global_step"]).checkpoint_key))
+    return weights, steps
+
+
+def read_numpy(path):
+    """TF weight names to values from an .npz, e.g. written with
+    np.savez(path, **{w.name: w.numpy() for w in model.weights})."""
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def main(cmd):
+    cfg = yaml.safe_load(cmd.cfg.read())
+    net = Net()
+    net.set_format_from_cfg(cfg)
+
+    if cmd.input.endswith(".npz"):
+        if cmd.swa:
+            raise ValueError("--swa needs a checkpoint")
+        weights, steps = read_numpy(cmd.input), None
+    else:
+        weights, steps = read_checkpoint(cmd.input, swa=cmd.swa)
+    if cmd.steps is not None:
+        steps = cmd.steps
+    if steps is not None:
+        net.pb.training_params.training_steps = steps
+
+    output = cmd.output
+    if output is None:
+        if steps is None:
+            raise ValueError("Pass --output or --steps for .npz input")
+        output = os.path.join(
+            cfg["training"]["path"], cfg["name"],
+            "{}-{}{}".format(cfg["name"], "swa-" if cmd.swa else "", steps))
+    net.fill_net_v2(list(weights.items()))
+    net.save_proto(output)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Convert a checkpoint to a net without building the model.")
+    argparser.add_argument("--cfg",
+                           type=argparse.FileType("r"),
+                           help="yaml configuration with training parameters")
+    argparser.add_argument("--input",
+                           type=str,
+                           help="checkpoint prefix, checkpoint directory (latest is used) or .npz of weights by TF name")
+    argparser.add_argument("--output",
+                           type=str,
+                           help="file to store weights in, default <path>/<name>/<name>-<steps>")
+    argparser.add_argument("--swa",
+                           action="store_true",
+                           help="convert the SWA weights of the checkpoint")
+    argparser.add_argument("--steps",
+                           type=int,
+                           help="training steps to record, default the checkpoint's global step")
+
+    main(argparser.parse_args())
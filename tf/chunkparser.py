@@ -128,11 +128,20 @@ def reverse_board(planes):
     return planes
 
 
-def chunk_reader(chunk_filenames, chunk_filename_queue):
+def chunk_reader(chunk_filenames, chunk_filename_queue, repeat=True,
+                 workers=0):
     """
     Reads chunk filenames from a list and writes them in shuffled
-    order to output_pipes.
+    order to output_pipes. Without repeat every chunk is written once,
+    followed by a None for each of the workers.
     """
+    if not repeat:
+        for filename in chunk_filenames:
+            chunk_filename_queue.put(filename)
+        for _ in range(workers):
+            chunk_filename_queue.put(None)
+        return None
+
     chunks = []
     done = chunk_filenames
 
@@ -166,22 +175,27 @@ class ChunkParser:
                  diff_focus_pol_scale=3.5,
                  pc_min=None,
                  pc_max=None,
-                 workers=None):
+                 workers=None,
+                 repeat=True):
         self.inner = ChunkParserInner(self, chunks, expected_input_format,
                                       shuffle_size, sample, buffer_size,
                                       batch_size, diff_focus_min,
                                       diff_focus_slope, diff_focus_q_weight,
-                                      diff_focus_pol_scale, workers, pc_min, pc_max)
+                                      diff_focus_pol_scale, workers, pc_min,
+                                      pc_max, repeat)
 
     def shutdown(self):
         """
         Terminates all the workers
         """
-        for i in range(len(self.processes)):
-            self.processes[i].terminate()
-            self.processes[i].join()
-            self.inner.readers[i].close()
-            self.inner.writers[i].close()
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        # Readers of finished workers were already closed by v7_gen.
+        for reader in self.inner.readers:
+            reader.close()
+        for writer in self.inner.writers:
+            writer.close()
         self.chunk_process.terminate()
         self.chunk_process.join()
 
@@ -190,6 +204,13 @@ class ChunkParser:
 
     def sequential(self):
         return self.inner.sequential()
+
+    def stats(self):
+        """
+        Returns the shuffle buffer fill fraction and the number of records
+        received from each worker so far.
+        """
+        return self.inner.stats()
     
 
 
@@ -378,7 +399,7 @@ class ChunkParserInner:
     def __init__(self, parent, chunks, expected_input_format, shuffle_size,
                  sample, buffer_size, batch_size, diff_focus_min,
                  diff_focus_slope, diff_focus_q_weight, diff_focus_pol_scale, 
-                 workers, pc_min=None, pc_max=None):
+                 workers, pc_min=None, pc_max=None, repeat=True):
         """
         Read data and yield batches of raw tensors.
 
@@ -388,6 +409,8 @@ class ChunkParserInner:
         "sample" is the rate to down-sample.
         "diff_focus_min", "diff_focus_slope", "diff_focus_q_weight" and "diff_focus_pol_scale" control diff focus
         "workers" is the number of child workers to use.
+        "repeat" cycles through the chunks forever, otherwise parse() ends
+        after every chunk was read once.
 
         The data is represented in a number of formats through this dataflow
         pipeline. In order, they are:
@@ -418,6 +441,8 @@ class ChunkParserInner:
         self.batch_size = batch_size
         # set number of elements in the shuffle buffer.
         self.shuffle_size = shuffle_size
+        self.sbuff = None
+        self.worker_records = []
         # Start worker processes, leave 2 for TensorFlow
         if workers is None:
             workers = max(1, mp.cpu_count() - 2)
@@ -442,7 +467,8 @@ class ChunkParserInner:
 
             parent.chunk_process = mp.Process(target=chunk_reader,
                                               args=(chunks,
-                                                    self.chunk_filename_queue))
+                                                    self.chunk_filename_queue,
+                                                    repeat, workers))
             parent.chunk_process.daemon = True
             parent.chunk_process.start()
         else:
@@ -574,6 +600,10 @@ class ChunkParserInner:
         """
         while True:
             filename = chunk_filename_queue.get()
+            if filename is None:
+                # No more chunks, an empty message tells the parent.
+                writer.send_bytes(b"")
+                return
             for item in self.single_file_gen(filename):
                 writer.send_bytes(item)
 
@@ -583,10 +613,19 @@ class ChunkParserInner:
         records.
         """
         sbuff = sb.ShuffleBuffer(v7b_struct.size, self.shuffle_size)
+        self.sbuff = sbuff
+        self.worker_records = [0] * len(self.readers)
+        worker_index = {r: i for i, r in enumerate(self.readers)}
         while len(self.readers):
-            for r in self.readers:
+            # A copy, finished readers are removed while going through it.
+            for r in list(self.readers):
                 try:
                     s = r.recv_bytes()
+                    if not s:
+                        self.readers.remove(r)
+                        r.close()
+                        continue
+                    self.worker_records[worker_index[r]] += 1
                     s = sbuff.insert_or_replace(s)
                     if s is None:
                         continue  # shuffle buffer not yet full
@@ -594,6 +633,7 @@ class ChunkParserInner:
                 except EOFError:
                     print("Reader EOF")
                     self.readers.remove(r)
+                    r.close()
         # drain the shuffle buffer.
         while True:
             s = sbuff.extract()
@@ -601,6 +641,15 @@ class ChunkParserInner:
                 return
             yield s
 
+    def stats(self):
+        fill = 0.0
+        if self.sbuff is not None:
+            fill = self.sbuff.used / self.sbuff.elem_count
+        return {
+            "shuffle_fill": fill,
+            "worker_records": list(self.worker_records)
+        }
+
     def tuple_gen(self, gen):
         """
         Take a generator producing v7 records and convert them to tuples.
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import json
+import os
+import sys
+import yaml
+from chunkparser import ChunkParser
+from train import get_all_chunks, get_input_mode
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def load_weights(tfp, path, swa=False):
+    """Net file through replace_weights, anything else is a checkpoint prefix
+    or a directory holding checkpoints. Returns the model holding the
+    weights and their training steps."""
+    if path.endswith(".gz"):
+        if swa:
+            raise ValueError("Net files have no SWA weights: {}".format(path))
+        tfp.replace_weights(path)
+        return tfp.model, int(tfp.net.pb.training_params.training_steps)
+    import tensorflow as tf
+    if os.path.isdir(path):
+        path = tf.train.latest_checkpoint(path)
+    if swa and not tfp.swa_enabled:
+        raise ValueError("Set training.swa to read the SWA weights of {}".format(path))
+    print("Restoring from {}".format(path))
+    tfp.checkpoint.restore(path).expect_partial()
+    return tfp.swa_model if swa else tfp.model, int(tfp.global_step.numpy())
+
+
+def load_models(tfp, nets):
+    """A model per net, a checkpoint followed by :swa gives its SWA weights.
+    Every net but a single one is copied into a model of its own."""
+    from tfprocess import assign_weights
+    models = []
+    steps = []
+    for net in nets:
+        swa = net.endswith(":swa")
+        model, net_steps = load_weights(tfp, net[:-len(":swa")] if swa else net,
+                                        swa)
+        if len(nets) > 1:
+            source = model
+            model = tfp.build_model()
+            assign_weights(model.weights, source.weights)
+        models.append(model)
+        steps.append(net_steps)
+    return models, steps
+
+
+def main(cmd):
+    cfg = yaml.safe_load(cmd.cfg.read())
+    if cmd.precision is not None:
+        cfg["training"]["precision"] = cmd.precision
+    # Mixed precision only changes the compute dtype, weights load the same.
+    cfg["training"].setdefault("precision", "half")
+    batch_size = cmd.batch_size or cfg["training"]["batch_size"]
+
+    if cmd.workers is not None and cmd.workers < 1:
+        raise ValueError("--workers must be at least 1")
+    chunks = get_all_chunks(cmd.input or cfg["dataset"]["input_test"])
+    if not chunks:
+        raise ValueError("No chunks found")
+    parser = ChunkParser(sorted(chunks),
+                         get_input_mode(cfg),
+                         shuffle_size=1,
+                         sample=1,
+                         batch_size=batch_size,
+                         workers=cmd.workers,
+                         repeat=False)
+
+    import tensorflow as tf
+    from chunkparsefunc import parse_function
+    from tfprocess import TFProcess
+
+    tfp = TFProcess(cfg, mode="eval")
+    if tfp.strategy is not None:
+        with tfp.strategy.scope():
+            tfp.init_net()
+            models, steps = load_models(tfp, cmd.net)
+    else:
+        tfp.init_net()
+        models, steps = load_models(tfp, cmd.net)
+
+    dataset = tf.data.Dataset.from_generator(parser.parse,
+                                             output_types=9 * (tf.string, ))
+    dataset = dataset.map(parse_function)
+    if tfp.strategy is None:
+        dataset = dataset.prefetch(4)
+    else:
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        dataset = tfp.distribute_dataset(dataset.with_options(options))
+
+    metric_lists = [[copy.copy(metric) for metric in tfp.test_metrics]
+                    for _ in models]
+    positions = tfp.evaluate_models(dataset,
+                                    models,
+                                    metric_lists,
+                                    stacked=cmd.stacked)
+    parser.shutdown()
+
+    result = {
+        "positions": positions,
+        "chunks": len(chunks),
+        "nets": [{
+            "net": net,
+            "steps": net_steps,
+            "metrics": {
+                metric.long_name: float(metric.get())
+                for metric in metrics
+            },
+        } for net, net_steps, metrics in zip(cmd.net, steps, metric_lists)],
+    }
+    # Side by side, a column per net.
+    print("{} positions".format(positions))
+    width = max(len(metric.short_name) for metric in tfp.test_metrics) + 1
+    for row, metric in enumerate(tfp.test_metrics):
+        print(metric.short_name.ljust(width), end="")
+        for metrics in metric_lists:
+            print(" {:>12.6g}{}".format(metrics[row].get(), metric.suffix),
+                  end="")
+        print()
+    if cmd.output is None:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        with open(cmd.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Compute the test metrics of a net over chunk data.")
+    argparser.add_argument("--cfg",
+                           type=argparse.FileType("r"),
+                           help="yaml configuration with the model parameters")
+    argparser.add_argument("--net",
+                           type=str,
+                           nargs="+",
+                           help="net files, checkpoint prefixes or checkpoint directories, "
+                           "append :swa to a checkpoint for its SWA weights")
+    argparser.add_argument("--input",
+                           type=str,
+                           nargs="+",
+                           help="chunk globs, default dataset.input_test")
+    argparser.add_argument("--batch-size",
+                           type=int,
+                           help="positions per batch, default training.batch_size")
+    argparser.add_argument("--precision",
+                           type=str,
+                           help="single, half or bfloat16, default training.precision or half")
+    argparser.add_argument("--workers",
+                           type=int,
+                           help="chunk reading processes, default all but two cores")
+    argparser.add_argument("--stacked",
+                           action="store_true",
+                           help="run all nets in one function call per batch")
+    argparser.add_argument("--output",
+                           type=str,
+                           help="JSON file for the results, default stdout")
+
+    main(argparser.parse_args())
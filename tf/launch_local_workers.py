@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+
+def main(cmd):
+    cfg = yaml.safe_load(cmd.cfg.read())
+    cfg["cluster"] = {
+        "workers": [
+            "localhost:{}".format(cmd.port + i) for i in range(cmd.workers)
+        ],
+        "task_index": 0,
+    }
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml",
+                                     delete=False) as f:
+        yaml.dump(cfg, f)
+        cfg_path = f.name
+
+    env = dict(os.environ)
+    if not cmd.gpu:
+        env["CUDA_VISIBLE_DEVICES"] = ""
+    train_py = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "train.py")
+    processes = []
+    for i in range(cmd.workers):
+        args = [sys.executable, train_py, "--cfg", cfg_path, "--task-index",
+                str(i)]
+        if cmd.output is not None and i == 0:
+            args += ["--output", cmd.output]
+        processes.append(subprocess.Popen(args, env=env))
+        print("Started worker {} (pid {})".format(i, processes[-1].pid))
+
+    # Stop everything as soon as one worker fails, the others would block
+    # forever in collectives.
+    returncode = 0
+    try:
+        while any(p.poll() is None for p in processes):
+            failed = [p for p in processes if p.poll()]
+            if failed:
+                returncode = failed[0].returncode
+                print("A worker exited with code {}, stopping".format(
+                    returncode))
+                break
+            time.sleep(1)
+        else:
+            returncode = max(p.returncode for p in processes)
+    finally:
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+        for p in processes:
+            p.wait()
+        os.remove(cfg_path)
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Run multi-worker training with local worker processes.")
+    argparser.add_argument("--cfg",
+                           type=argparse.FileType("r"),
+                           help="yaml configuration with training parameters")
+    argparser.add_argument("--workers",
+                           type=int,
+                           default=2,
+                           help="number of worker processes")
+    argparser.add_argument("--port",
+                           type=int,
+                           default=23456,
+                           help="first of the ports used by the workers")
+    argparser.add_argument("--gpu",
+                           action="store_true",
+                           help="let workers see the GPUs instead of running on CPU")
+    argparser.add_argument("--output",
+                           type=str,
+                           help="file to store weights in")
+
+    main(argparser.parse_args())
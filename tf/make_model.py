@@ -17,7 +17,7 @@ cfg = yaml.safe_load(args.cfg.read())
 print(yaml.dump(cfg, default_flow_style=False))
 START_FROM = args.start
 
-tfp = tfprocess.TFProcess(cfg)
+tfp = tfprocess.TFProcess(cfg, mode="export")
 tfp.init_net()
 tfp.global_step.assign(START_FROM)
 
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+import argparse
+import yaml
+
+# Bytes per activation element by training.precision.
+PRECISION_BYTES = {"single": 4, "half": 2, "bfloat16": 2}
+
+
+def dense(name, rows, n_in, n_out, bias=True):
+    """Dense layer applied to rows vectors, FLOPs count a multiply-add as
+    two."""
+    return {
+        "name": name,
+        "params": n_in * n_out + (n_out if bias else 0),
+        "flops": 2 * rows * n_in * n_out,
+        "activations": rows * n_out,
+    }
+
+
+def op(name, flops, activations, params=0):
+    return {
+        "name": name,
+        "params": params,
+        "flops": flops,
+        "activations": activations,
+    }
+
+
+def norm(name, rows, size, rms):
+    # RMSNorm has a scale only, LayerNormalization also a bias.
+    return op(name, 4 * rows * size, rows * size,
+              params=size if rms else 2 * size)
+
+
+class ModelConfig:
+    """Sizes of the model section, with the defaults of TFProcess."""
+    def __init__(self, model):
+        self.embedding_size = model["embedding_size"]
+        # Optional sizes may also be given as null for the default.
+        self.pol_embedding_size = model.get(
+            "policy_embedding_size") or self.embedding_size
+        self.val_embedding_size = model.get("value_embedding_size") or 32
+        self.mov_embedding_size = model.get("moves_left_embedding_size") or 8
+        self.encoder_layers = model["encoder_layers"]
+        self.encoder_heads = model["encoder_heads"]
+        self.encoder_d_model = model.get(
+            "encoder_d_model") or self.embedding_size
+        self.encoder_dff = int(
+            model.get("encoder_dff") or (self.embedding_size * 1.5) // 1)
+        self.glu = model.get("glu", False)
+        self.policy_d_model = model.get(
+            "policy_d_model") or self.embedding_size
+        self.policy_d_aux = model.get("policy_d_aux") or self.policy_d_model
+        self.policy_optimistic_st = model.get("policy_optimistic_st", False)
+        self.soft_policy = model.get("soft_policy", False)
+        self.policy_opponent = model.get("policy_opponent", False)
+        self.policy_next = model.get("policy_next", False)
+        self.embedding_style = model.get("embedding_style", "new").lower()
+        self.embedding_dense_sz = model.get("embedding_dense_sz") or 128
+        self.use_smolgen = model.get("use_smolgen", False)
+        self.smolgen_hidden_channels = model.get("smolgen_hidden_channels")
+        self.smolgen_hidden_sz = model.get("smolgen_hidden_sz")
+        self.smolgen_gen_sz = model.get("smolgen_gen_sz")
+        self.use_rpe_q = model.get("use_rpe_q", False)
+        self.use_rpe_k = model.get("use_rpe_k", False)
+        self.use_rpe_v = model.get("use_rpe_v", False)
+        self.use_logit_gating = model.get("use_logit_gating", False)
+        self.use_absolute_pe = model.get("use_absolute_pe", False)
+        self.omit_qkv_biases = model.get("omit_qkv_biases", False)
+        self.omit_other_biases = model.get("omit_other_biases", False)
+        self.encoder_rms_norm = model.get("encoder_rms_norm", False)
+        self.wdl = model.get("value", "wdl") == "wdl"
+        self.value_q = model.get("value_q", False)
+        self.value_st = model.get("value_st", False)
+        self.categorical_value_buckets = model.get(
+            "categorical_value_buckets") or 0
+        self.moves_left = model.get("moves_left", "v1") != "none"
+
+
+def embedding_rows(c):
+    E = c.embedding_size
+    rms = c.encoder_rms_norm
+    if c.embedding_style == "old":
+        return [
+            dense("embedding", 64, 112, E),
+            op("embedding/gating", 2 * 64 * E, 2 * 64 * E, params=2 * 64 * E),
+        ]
+    rows = [
+        dense("embedding/preprocess", 1, 64 * 12, 64 * c.embedding_dense_sz),
+        dense("embedding", 64, 112 + c.embedding_dense_sz, E),
+        norm("embedding/ln", 64, E, rms),
+        op("embedding/gating", 2 * 64 * E, 2 * 64 * E, params=2 * 64 * E),
+    ]
+    rows += ffn_rows(c, "embedding/ffn")
+    rows.append(norm("embedding/ffn_ln", 64, E, rms))
+    return rows
+
+
+def ffn_rows(c, name):
+    E = c.embedding_size
+    bias = not c.omit_other_biases
+    rows = [dense(name + "/dense1", 64, E, c.encoder_dff, bias)]
+    if c.glu:
+        rows.append(dense(name + "/dense3", 64, E, c.encoder_dff, bias))
+    rows.append(dense(name + "/dense2", 64, c.encoder_dff, E, bias))
+    return rows
+
+
+def encoder_rows(c, name):
+    E = c.embedding_size
+    d = c.encoder_d_model
+    h = c.encoder_heads
+    qkv_bias = not c.omit_qkv_biases
+    rows = []
+    if c.use_absolute_pe:
+        rows.append(
+            op(name + "/mha/abs_pe", 64 * E, 64 * E, params=64 * E))
+    rows += [
+        dense(name + "/mha/wq", 64, E, d, qkv_bias),
+        dense(name + "/mha/wk", 64, E, d, qkv_bias),
+        dense(name + "/mha/wv", 64, E, d, qkv_bias),
+        op(name + "/mha/qk", 2 * 64 * 64 * d, h * 64 * 64),
+    ]
+    # Relative position encodings: 15x15 offsets per head dimension.
+    for kind, enabled in [("q", c.use_rpe_q), ("k", c.use_rpe_k)]:
+        if enabled:
+            rows.append(
+                op(name + "/mha/rpe_" + kind,
+                   2 * 64 * 64 * d,
+                   h * 64 * 64,
+                   params=d * 15 * 15))
+    if c.use_smolgen:
+        s = name + "/mha/smolgen"
+        hc = c.smolgen_hidden_channels
+        hs = c.smolgen_hidden_sz
+        gs = c.smolgen_gen_sz
+        rows += [
+            dense(s + "/compress", 64, E, hc, bias=False),
+            dense(s + "/hidden1_dense", 1, 64 * hc, hs),
+            norm(s + "/hidden1_ln", 1, hs, False),
+            dense(s + "/gen_from", 1, hs, h * gs),
+            norm(s + "/gen_from_ln", 1, h * gs, False),
+            # The weight generator is shared, its parameters are counted
+            # once in smol_weight_gen.
+            op(s + "/weight_gen", 2 * h * gs * 64 * 64, h * 64 * 64),
+        ]
+    if c.use_logit_gating:
+        rows.append(
+            op(name + "/mha/rel_bias",
+               h * 64 * 64,
+               h * 64 * 64,
+               params=h * 64 * 64))
+    rows += [
+        op(name + "/mha/softmax", 5 * h * 64 * 64, h * 64 * 64),
+        op(name + "/mha/attention_v", 2 * 64 * 64 * d, 64 * d),
+    ]
+    if c.use_rpe_v:
+        rows.append(
+            op(name + "/mha/rpe_v",
+               2 * 64 * 64 * d,
+               64 * d,
+               params=d * 15 * 15))
+    rows += [
+        dense(name + "/mha/dense", 64, d, E, not c.omit_other_biases),
+        norm(name + "/ln1", 64, E, c.encoder_rms_norm),
+    ]
+    rows += ffn_rows(c, name + "/ffn")
+    rows.append(norm(name + "/ln2", 64, E, c.encoder_rms_norm))
+    return rows
+
+
+def policy_rows(c):
+    P = c.pol_embedding_size
+    rows = [dense("policy/embedding", 64, c.embedding_size, P)]
+    heads = [("policy/vanilla", c.policy_d_model)]
+    if c.policy_optimistic_st:
+        heads.append(("policy/optimistic_st", c.policy_d_model))
+    if c.soft_policy:
+        heads.append(("policy/soft", c.policy_d_aux))
+    for name, depth in heads:
+        rows += [
+            dense(name + "/attention/wq", 64, P, depth),
+            dense(name + "/attention/wk", 64, P, depth),
+            op(name + "/attention/qk", 2 * 64 * 64 * depth, 64 * 64),
+            dense(name + "/attention/ppo", 8, depth, 4, bias=False),
+        ]
+    for name, enabled in [("policy/opponent", c.policy_opponent),
+                          ("policy/next", c.policy_next)]:
+        if enabled:
+            rows.append(dense(name + "/attention/wq", 64, P, 2))
+    return rows
+
+
+def value_rows(c, name, outputs, use_err, use_cat):
+    rows = [
+        dense(name + "/embedding", 64, c.embedding_size,
+              c.val_embedding_size),
+        dense(name + "/dense1", 1, 64 * c.val_embedding_size, 128),
+        dense(name + "/dense2", 1, 128, outputs),
+    ]
+    if use_err:
+        rows.append(dense(name + "/dense_error", 1, 128, 1))
+    if use_cat and c.categorical_value_buckets:
+        rows.append(
+            dense(name + "/dense_cat", 1, 128, c.categorical_value_buckets))
+    return rows
+
+
+def moves_left_rows(c):
+    return [
+        dense("moves_left/embedding", 64, c.embedding_size,
+              c.mov_embedding_size),
+        dense("moves_left/dense1", 1, 64 * c.mov_embedding_size, 128),
+        dense("moves_left/dense2", 1, 128, 1),
+    ]
+
+
+def profile_rows(model):
+    """Parameters, forward FLOPs and activation elements per position of
+    every layer of the model section of a config, as built by
+    TFProcess.construct_net."""
+    c = ModelConfig(model)
+    rows = []
+    if c.use_smolgen:
+        rows.append(
+            op("smol_weight_gen", 0, 0, params=c.smolgen_gen_sz * 64 * 64))
+    rows += embedding_rows(c)
+    for i in range(c.encoder_layers):
+        rows += encoder_rows(c, "encoder_{}".format(i + 1))
+    rows += policy_rows(c)
+    rows += value_rows(c, "value/winner", 3 if c.wdl else 1, False, False)
+    if c.value_q:
+        rows += value_rows(c, "value/q", 1, True, True)
+    if c.value_st:
+        rows += value_rows(c, "value/st", 1, True, True)
+    if c.moves_left:
+        rows += moves_left_rows(c)
+    return rows
+
+
+def block_name(name):
+    # encoder_3/mha/wq -> encoder_3, value/q/dense1 -> value/q
+    parts = name.split("/")
+    if parts[0] in ("policy", "value"):
+        return "/".join(parts[:2])
+    return parts[0]
+
+
+def summarize(rows, cfg, batch_size):
+    """Totals of the rows for a batch. Layers with activation checkpointing
+    only keep their input for the backward pass."""
+    training = cfg.get("training", {})
+    bytes_per_element = PRECISION_BYTES[training.get("precision", "single")]
+    checkpointed = training.get("checkpoint_activations", False)
+    encoder_layers = cfg["model"]["encoder_layers"]
+    if checkpointed is True:
+        checkpointed = range(1, encoder_layers + 1)
+    checkpointed = {"encoder_{}".format(i) for i in checkpointed or []}
+
+    activations = 0
+    for row in rows:
+        if block_name(row["name"]) not in checkpointed:
+            activations += row["activations"]
+    activations += len(checkpointed) * 64 * cfg["model"]["embedding_size"]
+    return {
+        "params": sum(row["params"] for row in rows),
+        "flops": sum(row["flops"] for row in rows),
+        "activation_bytes": activations * bytes_per_element * batch_size,
+    }
+
+
+def total_flops(model):
+    """Forward FLOPs of one position."""
+    return sum(row["flops"] for row in profile_rows(model))
+
+
+def human(n):
+    for unit in ["", "K", "M", "G", "T"]:
+        if abs(n) < 1000:
+            return "{:.4g}{}".format(n, unit)
+        n /= 1000
+    return "{:.4g}P".format(n)
+
+
+def print_rows(rows, batch_size, bytes_per_element, detail=False):
+    """Table of the layers, or of the blocks they belong to."""
+    if not detail:
+        blocks = {}
+        for row in rows:
+            block = blocks.setdefault(block_name(row["name"]),
+                                      op(block_name(row["name"]), 0, 0))
+            for key in ("params", "flops", "activations"):
+                block[key] += row[key]
+        rows = list(blocks.values())
+    width = max(len(row["name"]) for row in rows) + 2
+    print("{}{:>10} {:>10} {:>10}".format("layer".ljust(width), "params",
+                                          "FLOPs", "act mem"))
+    for row in rows:
+        print("{}{:>10} {:>10} {:>10}".format(
+            row["name"].ljust(width), human(row["params"]),
+            human(row["flops"] * batch_size),
+            human(row["activations"] * bytes_per_element * batch_size) +
+            "B"))
+
+
+def main(cmd):
+    results = []
+    for f in cmd.cfg:
+        cfg = yaml.safe_load(f.read())
+        rows = profile_rows(cfg["model"])
+        summary = summarize(rows, cfg, cmd.batch_size)
+        # Backward is about twice the forward FLOPs.
+        flops_per_second = cmd.tflops * 1e12 * cmd.utilization
+        summary["train_positions_per_second"] = flops_per_second / (
+            3 * summary["flops"])
+        summary["inference_positions_per_second"] = flops_per_second / summary[
+            "flops"]
+        results.append((cfg.get("name", f.name), summary))
+
+        if cmd.layers or len(cmd.cfg) == 1:
+            print("{} (batch {})".format(results[-1][0], cmd.batch_size))
+            bytes_per_element = PRECISION_BYTES[cfg.get("training", {}).get(
+                "precision", "single")]
+            print_rows(rows, cmd.batch_size, bytes_per_element,
+                       detail=cmd.detail)
+            print()
+
+    # Ranked by estimated training throughput.
+    results.sort(key=lambda r: r[1]["train_positions_per_second"],
+                 reverse=True)
+    width = max(len(name) for name, _ in results) + 2
+    print("{}{:>10} {:>10} {:>10} {:>12} {:>12}".format(
+        "config".ljust(width), "params", "FLOPs/pos", "act mem", "train pos/s",
+        "infer pos/s"))
+    for name, s in results:
+        print("{}{:>10} {:>10} {:>10} {:>12} {:>12}".format(
+            name.ljust(width), human(s["params"]), human(s["flops"]),
+            human(s["activation_bytes"]) + "B",
+            human(s["train_positions_per_second"]),
+            human(s["inference_positions_per_second"])))
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Estimate FLOPs, parameters and activation memory of model configs.")
+    argparser.add_argument("--cfg",
+                           type=argparse.FileType("r"),
+                           nargs="+",
+                           help="yaml configurations to profile and rank")
+    argparser.add_argument("--batch-size",
+                           type=int,
+                           default=1024,
+                           help="positions per batch for FLOPs and memory")
+    argparser.add_argument("--layers",
+                           action="store_true",
+                           help="print the per-layer table of every config")
+    argparser.add_argument("--detail",
+                           action="store_true",
+                           help="one row per layer instead of per block")
+    argparser.add_argument("--tflops",
+                           type=float,
+                           default=100.0,
+                           help="peak TFLOPS of the device at the training precision")
+    argparser.add_argument("--utilization",
+                           type=float,
+                           default=0.4,
+                           help="fraction of the peak reached, for the throughput estimate")
+
+    main(argparser.parse_args())
@@ -12,7 +12,7 @@ args = argparser.parse_args()
 cfg = yaml.safe_load(args.cfg.read())
 print(yaml.dump(cfg, default_flow_style=False))
 
-tfp = tfprocess.TFProcess(cfg)
+tfp = tfprocess.TFProcess(cfg, mode="export")
 tfp.init_net()
 
 tfp.restore()
@@ -4,6 +4,7 @@ import argparse
 import gzip
 import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import proto.net_pb2 as pb
 
 LC0_MAJOR = 0
@@ -17,6 +18,63 @@ LC0_MINOR_WITH_MULTIHEAD = 31
 LC0_PATCH = 0
 WEIGHTS_MAGIC = 0x1c0
 
+# Per layer encodings are only read, and only exist in a net_pb2 generated
+# from a recent lczero-common net.proto.
+LAYER_ENCODING = 'encoding' in pb.Weights.Layer.DESCRIPTOR.fields_by_name
+
+# Values shared by Format.Encoding and Layer.Encoding.
+LINEAR16, FLOAT16, BFLOAT16, FLOAT32 = 1, 2, 3, 4
+
+# Whole net encodings by config name. The float ones only exist in a
+# net_pb2 generated from a recent lczero-common net.proto.
+WEIGHTS_ENCODINGS = {
+    "linear16": LINEAR16,
+    "float16": FLOAT16,
+    "bfloat16": BFLOAT16,
+}
+
+
+# Network format values by model config name.
+POLICY_FORMATS = {
+    "classical": pb.NetworkFormat.POLICY_CLASSICAL,
+    "convolution": pb.NetworkFormat.POLICY_CONVOLUTION,
+    "attention": pb.NetworkFormat.POLICY_ATTENTION,
+}
+VALUE_FORMATS = {
+    "classical": pb.NetworkFormat.VALUE_CLASSICAL,
+    "wdl": pb.NetworkFormat.VALUE_WDL,
+}
+MOVES_LEFT_FORMATS = {
+    "none": pb.NetworkFormat.MOVES_LEFT_NONE,
+    "v1": pb.NetworkFormat.MOVES_LEFT_V1,
+}
+INPUT_FORMATS = {
+    "classic":
+    pb.NetworkFormat.INPUT_CLASSICAL_112_PLANE,
+    "frc_castling":
+    pb.NetworkFormat.INPUT_112_WITH_CASTLING_PLANE,
+    "canonical":
+    pb.NetworkFormat.INPUT_112_WITH_CANONICALIZATION,
+    "canonical_100":
+    pb.NetworkFormat.INPUT_112_WITH_CANONICALIZATION_HECTOPLIES,
+    "canonical_armageddon":
+    pb.NetworkFormat.INPUT_112_WITH_CANONICALIZATION_HECTOPLIES_ARMAGEDDON,
+    "canonical_v2":
+    pb.NetworkFormat.INPUT_112_WITH_CANONICALIZATION_V2,
+    "canonical_v2_armageddon":
+    pb.NetworkFormat.INPUT_112_WITH_CANONICALIZATION_V2_ARMAGEDDON,
+}
+DEFAULT_ACTIVATIONS = {
+    "relu": pb.NetworkFormat.DEFAULT_ACTIVATION_RELU,
+    "mish": pb.NetworkFormat.DEFAULT_ACTIVATION_MISH,
+}
+
+
+def config_format(formats, kind, name):
+    if name not in formats:
+        raise ValueError("Unknown {} format: {}".format(kind, name))
+    return formats[name]
+
 
 def nested_getattr(obj, attr):
     attributes = attr.split(".")
@@ -29,6 +87,109 @@ def nested_getattr(obj, attr):
     return obj
 
 
+def split_fused_qkv(all_weights):
+    """Expand fused encoder wqkv weights into separate wq, wk and wv
+    entries, as stored in the protobuf."""
+    for name, weights in all_weights:
+        if '/wqkv/' in name:
+            for c, part in zip('qkv', np.split(weights, 3, axis=-1)):
+                yield name.replace('/wqkv/', '/w{}/'.format(c)), part
+        else:
+            yield name, weights
+
+
+def is_nm_sparse(weights, n=2, m=4):
+    """True for [out, in] weights with at most n non-zeros in every m
+    consecutive inputs, as left by sparse training."""
+    return (weights.ndim == 2 and weights.shape[1] % m == 0 and np.all(
+        np.count_nonzero(weights.reshape(-1, m), axis=1) <= n))
+
+
+def fake_quantize(x, s, n_bits=8):
+    """The quantization of tfprocess.quantize, s broadcast against x."""
+    q = 2**(n_bits - 1) - 1
+    return np.clip(np.round(x / (s + 1e-5)), -q, q) * s
+
+
+def to_bfloat16(params):
+    """float32 to bfloat16 bits, rounding to nearest even."""
+    bits = params.view(np.uint32)
+    return ((bits + 0x7fff + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+
+
+def from_bfloat16(bits):
+    return (bits.astype(np.uint32) << 16).view(np.float32)
+
+
+def decode_params(params, min_val, max_val, encoding, preserve_zeros=False):
+    """Weights of a protobuf layer as float32. With preserve_zeros, LINEAR16
+    layers that were encoded N:M sparse get their zeros back exactly."""
+    if encoding == FLOAT16:
+        return np.frombuffer(params, np.float16).astype(np.float32)
+    if encoding == BFLOAT16:
+        return from_bfloat16(np.frombuffer(params, np.uint16))
+    if encoding == FLOAT32:
+        return np.frombuffer(params, np.float32).copy()
+    codes = np.frombuffer(params, np.uint16)
+    params = codes.astype(np.float32) / 0xffff
+    params = params * (max_val - min_val) + min_val
+    if preserve_zeros and min_val < 0 < max_val:
+        # Sparse layers are encoded with zero on a code, which only decodes
+        # to about zero. Snap it so pruned weights stay pruned, unless the
+        # layer wasn't sparse and the code is an ordinary weight.
+        zero = -min_val / (max_val - min_val) * 0xffff
+        if abs(zero - round(zero)) < 0.01:
+            snapped = np.where(codes == round(zero), 0.0,
+                               params).astype(np.float32)
+            if snapped.size % 4 == 0 and is_nm_sparse(snapped.reshape(-1, 4)):
+                return snapped
+    return params
+
+
+def encode_float32(params):
+    """Fields of a protobuf layer holding params exactly, whatever the whole
+    net encoding is. Needs a net_pb2 with per layer encodings."""
+    return {
+        'encoding': FLOAT32,
+        'params': params.flatten().astype(np.float32).tobytes()
+    }
+
+
+def encode_layer(params, encoding=LINEAR16, preserve_zeros=False):
+    """Fields of a protobuf layer holding params in the given whole net
+    encoding. Only uses NumPy, so layers can be encoded in parallel."""
+    params = params.flatten().astype(np.float32)
+    if encoding == FLOAT16:
+        return {'params': params.astype(np.float16).tobytes()}
+    if encoding == BFLOAT16:
+        return {'params': to_bfloat16(params).tobytes()}
+
+    min_val = 0 if len(params) == 1 else float(np.min(params))
+    max_val = 1 if len(params) == 1 and np.max(
+        params) == 0 else float(np.max(params))
+    # Round trip through float32 like the protobuf fields do.
+    min_val, max_val = float(np.float32(min_val)), float(np.float32(max_val))
+    if preserve_zeros and min_val < 0 < max_val:
+        # Widen the range so that zero falls exactly on a code. Pruned
+        # weights then all share the code round(-min / (max - min) *
+        # 0xffff) and the sparsity pattern survives the encoding.
+        step = (max_val - min_val) / 0xfffe
+        min_val = float(np.float32(-np.ceil(-min_val / step) * step))
+        max_val = float(np.float32(min_val + 0xffff * step))
+    if max_val == min_val:
+        # Avoid division by zero if max == min.
+        params = (params - min_val)
+    else:
+        params = (params - min_val) / (max_val - min_val)
+    params *= 0xffff
+    params = np.round(params)
+    return {
+        'min_val': min_val,
+        'max_val': max_val,
+        'params': params.astype(np.uint16).tobytes()
+    }
+
+
 class Net:
 
     def __init__(self,
@@ -49,8 +210,19 @@ class Net:
         self.pb.min_version.minor = LC0_MINOR
         self.pb.min_version.patch = LC0_PATCH
         self.pb.format.weights_encoding = pb.Format.LINEAR16
+        # Encoding used by fill_net_v2, see set_weights_encoding.
+        self.weights_encoding = LINEAR16
+        # Threads for encoding layers and compressing in save_proto.
+        self.threads = 1
+        self.compresslevel = 9
+        # tf_name_to_pb_name results, they only depend on the name.
+        self.pb_name_cache = {}
+        self.layer_index_cache = None
 
         self.weights = []
+        # Bits of the quantization applied to quantize_weights kernels on
+        # export, None writes the kernels as trained.
+        self.dequantize_bits = None
 
         self.set_networkformat(net)
         self.pb.format.network_format.input = input
@@ -59,6 +231,75 @@ class Net:
         self.set_movesleftformat(moves_left)
         self.set_defaultactivation(pb.NetworkFormat.DEFAULT_ACTIVATION_RELU)
 
+    def set_weights_encoding(self, encoding):
+        """linear16 (min/max normalized 16 bit), float16 or bfloat16"""
+        if encoding not in WEIGHTS_ENCODINGS:
+            raise ValueError("Unknown weights encoding {}".format(encoding))
+        value = WEIGHTS_ENCODINGS[encoding]
+        if value not in pb.Format.Encoding.DESCRIPTOR.values_by_number:
+            raise ValueError(
+                "proto/net_pb2.py has no {} Format.Encoding, regenerate it from "
+                "a newer libs/lczero-common".format(encoding.upper()))
+        self.weights_encoding = value
+
+    def set_format_from_cfg(self, cfg):
+        """Network format and export settings of a training config, as used
+        by TFProcess. Only needs the config, not the model."""
+        model = cfg["model"]
+        training = cfg.get("training", {})
+        encoder_layers = model["encoder_layers"]
+        encoder_heads = model["encoder_heads"]
+
+        policy = config_format(POLICY_FORMATS, "policy head",
+                               model.get("policy", "attention"))
+        if policy == pb.NetworkFormat.POLICY_ATTENTION and encoder_layers > 0:
+            self.set_pol_headcount(encoder_heads)
+        self.set_policyformat(policy)
+        self.set_valueformat(
+            config_format(VALUE_FORMATS, "value head",
+                          model.get("value", "wdl")))
+        self.set_movesleftformat(
+            config_format(MOVES_LEFT_FORMATS, "moves left head",
+                          model.get("moves_left", "v1")))
+        self.set_input(
+            config_format(INPUT_FORMATS, "input mode",
+                          model.get("input_type", "classic")))
+        self.set_defaultactivation(
+            config_format(DEFAULT_ACTIVATIONS, "default activation",
+                          model.get("default_activation", "mish")))
+
+        if encoder_layers > 0:
+            self.set_headcount(encoder_heads)
+            self.set_networkformat(
+                pb.NetworkFormat.NETWORK_ATTENTIONBODY_WITH_MULTIHEADFORMAT)
+            self.set_smolgen_activation(
+                self.activation(model.get("smolgen_activation")))
+            self.set_ffn_activation(self.activation('default'))
+
+        if model.get("embedding_style", "new").lower() == "new":
+            self.set_input_embedding(
+                pb.NetworkFormat.INPUT_EMBEDDING_PE_DENSE)
+        elif encoder_layers > 0:
+            self.set_input_embedding(pb.NetworkFormat.INPUT_EMBEDDING_PE_MAP)
+        else:
+            self.set_input_embedding(pb.NetworkFormat.INPUT_EMBEDDING_NONE)
+
+        self.dequantize_bits = None
+        if training.get("export_dequantized", False):
+            if not LAYER_ENCODING or 'FLOAT32' not in \
+                    pb.Weights.Layer.Encoding.DESCRIPTOR.values_by_name:
+                # Int8 codes have no encoding in the lc0 schema, the
+                # quantized kernels are written as exact float32 instead.
+                raise ValueError(
+                    "export_dequantized needs float32 layer encodings, "
+                    "regenerate proto/net_pb2.py from a recent "
+                    "libs/lczero-common with init.sh")
+            self.dequantize_bits = model.get("quantize_weight_bits", 8)
+        self.set_weights_encoding(
+            training.get("weights_encoding", "linear16"))
+        self.threads = training.get("export_threads", 1)
+        self.compresslevel = training.get("export_compresslevel", 9)
+
     def set_networkformat(self, net):
         self.pb.format.network_format.network = net
         if net == pb.NetworkFormat.NETWORK_ATTENTIONBODY_WITH_HEADFORMAT \
@@ -145,20 +386,24 @@ class Net:
             return pb.NetworkFormat.ACTIVATION_NONE
         
         
-    def fill_layer_v2(self, layer, params):
+    @staticmethod
+    def set_layer(layer, fields):
+        layer.Clear()
+        for field, value in fields.items():
+            setattr(layer, field, value)
+
+    def encode_weights(self, weights):
+        return encode_layer(
+            weights, self.weights_encoding, self.weights_encoding == LINEAR16
+            and is_nm_sparse(weights))
+
+    def fill_layer_v2(self, layer, params, preserve_zeros=False):
         """Normalize and populate 16bit layer in protobuf"""
-        params = params.flatten().astype(np.float32)
-        layer.min_val = 0 if len(params) == 1 else float(np.min(params))
-        layer.max_val = 1 if len(params) == 1 and np.max(
-            params) == 0 else float(np.max(params))
-        if layer.max_val == layer.min_val:
-            # Avoid division by zero if max == min.
-            params = (params - layer.min_val)
-        else:
-            params = (params - layer.min_val) / (layer.max_val - layer.min_val)
-        params *= 0xffff
-        params = np.round(params)
-        layer.params = params.astype(np.uint16).tobytes()
+        self.layer_index_cache = None
+        self.set_layer(
+            layer,
+            encode_layer(params, self.pb.format.weights_encoding,
+                         preserve_zeros))
 
     def fill_layer(self, layer, weights):
         """Normalize and populate 16bit layer in protobuf"""
@@ -177,29 +422,104 @@ class Net:
 
     def denorm_layer_v2(self, layer):
         """Denormalize a layer from protobuf"""
-        params = np.frombuffer(layer.params, np.uint16).astype(np.float32)
-        params /= 0xffff
-        return params * (layer.max_val - layer.min_val) + layer.min_val
+        return decode_params(layer.params, layer.min_val, layer.max_val,
+                             self.layer_encoding(layer))
+
+    def layer_encoding(self, layer):
+        encoding = layer.encoding if LAYER_ENCODING else 0
+        return encoding or self.pb.format.weights_encoding
+
+    def layer_index(self):
+        """Every layer in the protobuf by dotted path, e.g.
+        'encoder.3.mha.q_w', as (params, min_val, max_val, encoding). Built
+        with one walk over the set fields on first use and dropped whenever
+        the protobuf is replaced or refilled."""
+        if self.layer_index_cache is None:
+            index = {}
+
+            def walk(message, path):
+                if message.DESCRIPTOR is pb.Weights.Layer.DESCRIPTOR:
+                    index[path] = (message.params, message.min_val,
+                                   message.max_val,
+                                   self.layer_encoding(message))
+                    return
+                prefix = path + '.' if path else ''
+                for field, value in message.ListFields():
+                    if field.type != field.TYPE_MESSAGE:
+                        continue
+                    if field.label == field.LABEL_REPEATED:
+                        for i, m in enumerate(value):
+                            walk(m, '{}{}.{}'.format(prefix, field.name, i))
+                    else:
+                        walk(value, prefix + field.name)
+
+            walk(self.pb.weights, '')
+            self.layer_index_cache = index
+        return self.layer_index_cache
+
+    def layer_at(self, path):
+        """Protobuf layer at a layer_index path."""
+        layer = self.pb.weights
+        for part in path.split('.'):
+            layer = layer[int(part)] if part.isdigit() else getattr(
+                layer, part)
+        return layer
+
+    def index_path(self, name):
+        """layer_index path of a TF weight name."""
+        pb_name, block, pol_encoder_block, encoder_block = self.tf_name_to_pb_name(
+            name)
+        if pb_name is None:
+            raise ValueError(
+                "Don't know where to store weight in protobuf: {}".format(
+                    name))
+        if block is not None:
+            return 'residual.{}.{}'.format(block, pb_name)
+        if pol_encoder_block is not None:
+            return 'pol_encoder.{}.{}'.format(pol_encoder_block, pb_name)
+        if encoder_block is not None:
+            return 'encoder.{}.{}'.format(encoder_block, pb_name)
+        return pb_name
 
     def denorm_layer(self, layer, weights):
         weights.insert(0, self.denorm_layer_v2(layer))
 
 
-    def save_proto(self, filename):
-        """Save weights gzipped protobuf file"""
+    def save_proto(self, filename, log=True, compresslevel=None, threads=None):
+        """Save weights gzipped protobuf file. With more than one thread the
+        file is a series of gzip members compressed in parallel, which gzip
+        readers (including zlib's gzread) read as one stream."""
         if len(filename.split('.')) == 1:
             filename += ".pb.gz"
+        if compresslevel is None:
+            compresslevel = self.compresslevel
+        if threads is None:
+            threads = self.threads
+
+        data = self.pb.SerializeToString()
+        if threads > 1:
+            size = -(-len(data) // threads)
+            with ThreadPoolExecutor(threads) as pool:
+                members = pool.map(
+                    lambda i: gzip.compress(data[i:i + size], compresslevel),
+                    range(0, len(data), size))
+                with open(filename, 'wb') as f:
+                    for member in members:
+                        f.write(member)
+        else:
+            with gzip.open(filename, 'wb', compresslevel=compresslevel) as f:
+                f.write(data)
 
-        with gzip.open(filename, 'wb') as f:
-            data = self.pb.SerializeToString()
-            f.write(data)
-
-        size = os.path.getsize(filename) / 1024**2
-        print("Weights saved as '{}' {}M".format(filename, round(size, 2)))
+        if log:
+            size = os.path.getsize(filename) / 1024**2
+            print("Weights saved as '{}' {}M".format(filename, round(size, 2)))
 
     def tf_name_to_pb_name(self, name):
         """Given Tensorflow variable name returns the protobuf name and index
         of residual block if weight belong in a residual block."""
+        if name in self.pb_name_cache:
+            return self.pb_name_cache[name]
+
         def value_to_bp(l, w):
             if l == 'dense_error':
                 w = w.split(':')[0]
@@ -387,14 +707,29 @@ class Net:
         else:
             raise ValueError('Unable to decode layer {}'.format(name))
 
+        self.pb_name_cache[name] = (pb_name, block, pol_encoder_block,
+                                    encoder_block)
         return (pb_name, block, pol_encoder_block, encoder_block)
 
     def get_weights_v2(self, names):
         # `names` is a list of Tensorflow tensor names to get from the protobuf.
         # Returns list of [Tensor name, Tensor weights].
+        # Weights missing from the protobuf are left out.
         tensors = {}
+        index = self.layer_index()
 
         for tf_name in names:
+            if '/wqkv/' in tf_name:
+                # Fused q, k and v in [out, in] order are the separate
+                # weights concatenated.
+                parts = self.get_weights_v2([
+                    tf_name.replace('/wqkv/', '/w{}/'.format(c))
+                    for c in 'qkv'
+                ])
+                if len(parts) == 3:
+                    tensors[tf_name] = np.concatenate(list(parts.values()))
+                continue
+
             name = tf_name
             if 'stddev' in name:
                 # Get variance instead of stddev.
@@ -406,25 +741,10 @@ class Net:
                 # headcount is set with set_headcount()
                 continue
 
-            pb_name, block, pol_encoder_block, encoder_block = self.tf_name_to_pb_name(
-                name)
-
-            if pb_name is None:
-                raise ValueError(
-                    "Don't know where to store weight in protobuf: {}".format(
-                        name))
-
-            if block is None:
-                if pol_encoder_block is not None:
-                    pb_weights = self.pb.weights.pol_encoder[pol_encoder_block]
-                elif encoder_block is not None:
-                    pb_weights = self.pb.weights.encoder[encoder_block]
-                else:
-                    pb_weights = self.pb.weights
-            else:
-                pb_weights = self.pb.weights.residual[block]
-
-            w = self.denorm_layer_v2(nested_getattr(pb_weights, pb_name))
+            path = self.index_path(name)
+            if path not in index:
+                continue
+            w = decode_params(*index[path], preserve_zeros=True)
 
             # Only variance is stored in the protobuf.
             if 'stddev' in tf_name:
@@ -437,6 +757,7 @@ class Net:
     def parse_proto(self, filename):
         with gzip.open(filename, 'rb') as f:
             self.pb = self.pb.FromString(f.read())
+        self.layer_index_cache = None
         # Populate policyFormat and valueFormat fields in old protobufs
         # without these fields.
         if self.pb.format.network_format.network == pb.NetworkFormat.NETWORK_CLASSICAL:
@@ -448,16 +769,29 @@ class Net:
 
 
 
-    def fill_net_v2(self, all_weights):
+    def fill_net_v2(self, all_weights, threads=None):
         # all_weights is array of [name of weight, numpy array of weights].
-        self.pb.format.weights_encoding = pb.Format.LINEAR16
+        self.pb.format.weights_encoding = self.weights_encoding
+        if threads is None:
+            threads = self.threads
 
         has_renorm = any('renorm' in w[0] for w in all_weights)
         weight_names = [w[0] for w in all_weights]
+        kernel_scales = {
+            name: w
+            for name, w in all_weights if name.endswith('/quantizer/s:0')
+        }
 
         del self.pb.weights.residual[:]
 
-        for name, weights in all_weights:
+        # The protobuf is only touched from this thread; the layers are
+        # encoded in parallel and filled in afterwards.
+        pb_layers = []
+        jobs = []
+        # Index paths and model kernels of the dequantized layers.
+        dequantized = []
+
+        for name, weights in split_fused_qkv(all_weights):
             layers = name.split('/')
             weights_name = layers[-1]
             if weights.ndim == 4:
@@ -520,7 +854,53 @@ class Net:
                     self.pb.weights.residual.add()
                 pb_weights = self.pb.weights.residual[block]
 
-            self.fill_layer_v2(nested_getattr(pb_weights, pb_name), weights)
+            pb_layers.append(nested_getattr(pb_weights, pb_name))
+            scale = kernel_scales.get(name.replace('/kernel:0',
+                                                   '/quantizer/s:0'))
+            if self.dequantize_bits is not None and scale is not None:
+                # The kernel the model computes with, scales are per output.
+                weights = fake_quantize(weights, scale.reshape(-1, 1),
+                                        self.dequantize_bits)
+                dequantized.append((self.index_path(name), weights))
+                jobs.append((encode_float32, weights))
+                continue
+            jobs.append((self.encode_weights, weights))
+
+        def run(job):
+            return job[0](*job[1:])
+
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as pool:
+                encoded = list(pool.map(run, jobs))
+        else:
+            encoded = [run(job) for job in jobs]
+        for layer, fields in zip(pb_layers, encoded):
+            self.set_layer(layer, fields)
+        self.layer_index_cache = None
+        if dequantized:
+            self.check_dequantized(dequantized)
+
+    def check_dequantized(self, dequantized, batch_size=64, seed=0):
+        """Compare x @ w for random x between each (path, kernel) in
+        dequantized and the layer decoded back from the protobuf."""
+        rng = np.random.default_rng(seed)
+        index = self.layer_index()
+        worst = 0.0
+        for path, weights in dequantized:
+            weights = weights.reshape(weights.shape[0], -1)
+            decoded = decode_params(*index[path]).reshape(weights.shape)
+            x = rng.standard_normal((batch_size, weights.shape[1]),
+                                    dtype=np.float32)
+            expected = x @ weights.T
+            error = np.max(np.abs(x @ decoded.T - expected)) / max(
+                np.max(np.abs(expected)), 1e-12)
+            if error > 1e-6:
+                raise ValueError(
+                    "Exported {} differs from the model, relative error "
+                    "{:.3g}".format(path, error))
+            worst = max(worst, error)
+        print("Checked {} dequantized layers, max relative error {:.3g}".format(
+            len(dequantized), worst))
 
 def print_pb_stats(obj, parent=None):
     for descriptor in obj.DESCRIPTOR.fields:
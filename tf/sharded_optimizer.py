@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import numpy as np
+import tensorflow as tf
+
+
+def local_variable(initial_value, name):
+    # Each replica keeps and updates its own copy; cross replica reads see
+    # the first replica's.
+    return tf.Variable(initial_value,
+                       name=name,
+                       trainable=False,
+                       synchronization=tf.VariableSynchronization.ON_READ,
+                       aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+
+
+class ShardedNadam:
+    """Nadam with the optimizer slots and gradient accumulators partitioned
+    across replicas, as in ZeRO stage 1.
+
+    Every variable is flattened, padded to a multiple of the number of
+    replicas and split into equal shards. Replica i only holds the i-th shard
+    of the gradient accumulator and of both moments, updates that shard of
+    the weights and the updated shards are then all-gathered. Gradients are
+    summed over replicas, like the default gradient aggregation.
+
+    Must be created inside the strategy scope. The slots can't be part of a
+    tf.train.Checkpoint, which only saves the first replica's copy of them;
+    save_state and restore_state write and read this worker's shards.
+
+    masks has a mask variable or None per variable; masked out gradient
+    entries are dropped before the moments are updated.
+    """
+    def __init__(self,
+                 variables,
+                 learning_rate,
+                 beta_1=0.9,
+                 beta_2=0.999,
+                 epsilon=1e-07,
+                 masks=None):
+        self.variables = list(variables)
+        self.masks = list(masks) if masks is not None else [None] * len(
+            self.variables)
+        self.learning_rate = learning_rate
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.epsilon = epsilon
+        self.strategy = tf.distribute.get_strategy()
+        self.num_shards = self.strategy.num_replicas_in_sync
+        self.shard_sizes = [
+            -(-v.shape.num_elements() // self.num_shards)
+            for v in self.variables
+        ]
+
+        def slots(prefix):
+            return [
+                local_variable(tf.zeros([size]),
+                               "{}/{}".format(prefix, i))
+                for i, size in enumerate(self.shard_sizes)
+            ]
+
+        self.accumulators = slots("accumulator")
+        self.m = slots("m")
+        self.v = slots("v")
+        self.iterations = local_variable(tf.constant(0, tf.int64),
+                                         "iterations")
+        self.u_product = local_variable(tf.constant(1.0), "u_product")
+
+    def local_shard(self, x, shard_size, replica_id):
+        x = tf.reshape(tf.cast(x, tf.float32), [-1])
+        x = tf.pad(x, [[0, shard_size * self.num_shards - x.shape[0]]])
+        return tf.reshape(x, [self.num_shards, shard_size])[replica_id]
+
+    def accumulate(self, grads):
+        """Sum grads over replicas and add this replica's shard of each to
+        the accumulators. Called in replica context."""
+        ctx = tf.distribute.get_replica_context()
+        grads = ctx.all_reduce(tf.distribute.ReduceOp.SUM,
+                               [tf.convert_to_tensor(g) for g in grads])
+        replica_id = ctx.replica_id_in_sync_group
+        for acc, g, size in zip(self.accumulators, grads, self.shard_sizes):
+            acc.assign_add(self.local_shard(g, size, replica_id))
+
+    def apply_accumulated(self, clip_norm):
+        """Apply the accumulated gradients, clipped to a global norm of
+        clip_norm, and reset the accumulators. Called in replica context,
+        returns the global norm before clipping."""
+        ctx = tf.distribute.get_replica_context()
+        replica_id = ctx.replica_id_in_sync_group
+        grad_norm = tf.sqrt(
+            ctx.all_reduce(
+                tf.distribute.ReduceOp.SUM,
+                tf.add_n([tf.reduce_sum(tf.square(a))
+                          for a in self.accumulators])))
+        # Same scaling as tf.clip_by_global_norm.
+        scale = clip_norm / tf.maximum(grad_norm, clip_norm)
+
+        # Nadam as in tf.keras.optimizers.Nadam.
+        lr = tf.cast(self.learning_rate, tf.float32)
+        local_step = tf.cast(self.iterations + 1, tf.float32)
+        u_t = self.beta_1 * (1.0 - 0.5 * tf.pow(0.96, local_step))
+        u_t_1 = self.beta_1 * (1.0 - 0.5 * tf.pow(0.96, local_step + 1))
+        u_product_t = self.u_product * u_t
+        u_product_t_1 = u_product_t * u_t_1
+        beta_2_power = tf.pow(self.beta_2, local_step)
+
+        shards = []
+        for var, mask, acc, m, v, size in zip(self.variables, self.masks,
+                                              self.accumulators, self.m,
+                                              self.v, self.shard_sizes):
+            g = acc * scale
+            if mask is not None:
+                g *= self.local_shard(mask, size, replica_id)
+            m_t = m.assign_add((g - m) * (1 - self.beta_1))
+            v_t = v.assign_add((tf.square(g) - v) * (1 - self.beta_2))
+            m_hat = (u_t_1 * m_t / (1 - u_product_t_1) +
+                     (1 - u_t) * g / (1 - u_product_t))
+            v_hat = v_t / (1 - beta_2_power)
+            shards.append(
+                self.local_shard(var, size, replica_id) -
+                m_hat * lr / (tf.sqrt(v_hat) + self.epsilon))
+            acc.assign(tf.zeros_like(acc))
+        self.u_product.assign(u_product_t)
+        self.iterations.assign_add(1)
+
+        values = ctx.all_gather(shards, axis=0)
+        values = [
+            tf.cast(tf.reshape(x[:var.shape.num_elements()], var.shape),
+                    var.dtype) for x, var in zip(values, self.variables)
+        ]
+        ctx.merge_call(self.assign_variables, args=(values, ))
+        return grad_norm
+
+    def save_state(self, filename):
+        """Write this worker's shards of the moments and the step counters.
+        Called between steps, when the accumulators are empty."""
+        strategy = self.strategy
+        state = {
+            "num_shards": self.num_shards,
+            "iterations": strategy.experimental_local_results(
+                self.iterations)[0].numpy(),
+            "u_product": strategy.experimental_local_results(
+                self.u_product)[0].numpy(),
+        }
+        for prefix, slots in [("m", self.m), ("v", self.v)]:
+            for i, slot in enumerate(slots):
+                for replica, value in enumerate(
+                        strategy.experimental_local_results(slot)):
+                    state["{}/{}/{}".format(prefix, i,
+                                            replica)] = value.numpy()
+        with tf.io.gfile.GFile(filename, "wb") as f:
+            np.savez(f, **state)
+
+    def restore_state(self, filename):
+        strategy = self.strategy
+        with tf.io.gfile.GFile(filename, "rb") as f:
+            state = dict(np.load(f))
+        if int(state["num_shards"]) != self.num_shards:
+            raise ValueError(
+                "{} holds optimizer state for {} replicas, not {}".format(
+                    filename, int(state["num_shards"]), self.num_shards))
+        for component in strategy.experimental_local_results(
+                self.iterations):
+            component.assign(state["iterations"])
+        for component in strategy.experimental_local_results(
+                self.u_product):
+            component.assign(state["u_product"])
+        for prefix, slots in [("m", self.m), ("v", self.v)]:
+            for i, slot in enumerate(slots):
+                for replica, component in enumerate(
+                        strategy.experimental_local_results(slot)):
+                    component.assign(state["{}/{}/{}".format(
+                        prefix, i, replica)])
+        for acc in self.accumulators:
+            for component in strategy.experimental_local_results(acc):
+                component.assign(tf.zeros_like(component))
+
+    def assign_variables(self, strategy, values):
+        for var, value in zip(self.variables, values):
+            strategy.extended.update(var,
+                                     lambda var, value: var.assign(value),
+                                     args=(value, ),
+                                     group=False)
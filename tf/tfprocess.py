@@ -27,38 +27,16 @@ import proto.net_pb2 as pb
 from functools import reduce
 import operator
 import functools
-from net import Net
+import copy
+import re
+import json
+from net import Net, is_nm_sparse
+from background import BackgroundWorker
+from sharded_optimizer import ShardedNadam
 
 from keras import backend as K
 
 
-# @tf.custom_gradient
-# def gradient_checkpointed_matmul(x, kernel, bias):
-#     out = tf.matmul(x, kernel) + bias
-#     def grad(dy):          
-#         # the gradients for x and bias are calculated normally and that for kernel is split up to reduce memory usage
-#         dx = tf.matmul(dy, tf.transpose(kernel))
-#         db = tf.reduce_sum(dy, axis=range(len(dy.shape) - 1)))
-#         x = tf.reshape(x, [-1, x.shape[-1]])
-#         dy = tf.reshape(dy, [-1, dy.shape[-1]])
-#         dk = tf.matmul(tf.transpose(x), dy)
-
-# 			  return dx, dk, db
-#     return out, grad
-
-@tf.custom_gradient
-def gradient_checkpointed_matmul(x, kernel):
-    out = tf.matmul(x, kernel)
-    def grad(dy):          
-        # the gradients for x and bias are calculated normally and that for kernel is split up to reduce memory usage
-        dx = tf.matmul(dy, tf.transpose(kernel))
-        xr = tf.reshape(x, [-1, x.shape[-1]])
-        dyr = tf.reshape(dy, [-1, dy.shape[-1]])
-        dk = tf.matmul(tf.transpose(xr), dyr)
-        return dx, dk
-    return out, grad
-    
-
 class ClipConstraint(tf.keras.constraints.Constraint):
     def __init__(self, min_value=-9999, max_value=9999):
         self.min_value = min_value
@@ -80,22 +58,45 @@ def count_major_pieces(x):
     out += tf.reduce_sum(x[:, :, 7:11], axis=[1,2])
     return out
 
-def make_rpe_map():
-    # 15 * 15 in units for distance pairs to 64 * 64 pairs of squares
-    out = np.zeros((225, 64*64), dtype=float)
-    for i in range(8):
-        for j in range(8):
-            for k in range(8):
-                for l in range(8):
-                    out[15 * (i-k+7) + (j - l + 7), 64 * (i*8+j) + k*8+l] = 1
-    return out
-
-rpe_map = make_rpe_map()
+def make_rpe_index():
+    # For each of the 64 * 64 (query, key) square pairs, the index of their
+    # rank and file distance in the 15 * 15 relative position table.
+    rank, file = np.divmod(np.arange(64), 8)
+    rank_dist = rank[:, None] - rank[None, :] + 7
+    file_dist = file[:, None] - file[None, :] + 7
+    return (15 * rank_dist + file_dist).reshape(64 * 64).astype(np.int32)
+
+rpe_index = make_rpe_index()
+
+def nm_sparsity_mask(kernel, fraction, n=2, m=4):
+    """Mask keeping the n largest of every m consecutive inputs of each
+    output for the given fraction of groups, those where pruning removes the
+    least magnitude. kernel is [in, out]; groups run along the input
+    dimension as sparse tensor cores expect."""
+    groups = tf.reshape(tf.transpose(tf.abs(kernel)), [-1, m])
+    top = tf.math.top_k(groups, k=n)
+    group_mask = tf.reduce_sum(tf.one_hot(top.indices, m, dtype=kernel.dtype),
+                               axis=1)
+    cost = tf.reduce_sum(groups, axis=1) - tf.reduce_sum(top.values, axis=1)
+    num_pruned = tf.cast(
+        tf.round(fraction * tf.cast(tf.shape(cost)[0], tf.float32)), tf.int32)
+    pruned = tf.argsort(tf.argsort(cost)) < num_pruned
+    group_mask = tf.where(pruned[:, None], group_mask,
+                          tf.ones_like(group_mask))
+    return tf.transpose(
+        tf.reshape(group_mask, [kernel.shape[1], kernel.shape[0]]))
 
     
 
 
 
+@tf.function
+def assign_weights(variables, values):
+    # One graph for all assignments instead of an eager op per variable.
+    for variable, value in zip(variables, values):
+        variable.assign(value)
+
+
 def get_activation(activation):
     if isinstance(activation, str) or activation is None:
         try:
@@ -218,6 +219,18 @@ class DenseLayer(tf.keras.layers.Layer):
         return self.activation(out)
 
 
+class ConcatInitializer(tf.keras.initializers.Initializer):
+    """Initializes equal blocks along the last axis with their own initializers,
+    so a fused kernel starts out like the separate kernels would."""
+    def __init__(self, initializers):
+        self.initializers = [tf.keras.initializers.get(i) for i in initializers]
+
+    def __call__(self, shape, dtype=None, **kwargs):
+        block_shape = list(shape[:-1]) + [shape[-1] // len(self.initializers)]
+        return tf.concat([i(block_shape, dtype=dtype) for i in self.initializers],
+                         axis=-1)
+
+
 class Gating(tf.keras.layers.Layer):
 
     def __init__(self, name=None, additive=True, init_value=None, **kwargs):
@@ -248,6 +261,18 @@ def ma_gating(inputs, name):
     return out
 
 
+class RecomputeGrad(tf.keras.layers.Layer):
+    """Calls a sub-model under tf.recompute_grad so its activations are
+    recomputed during the backward pass instead of being kept in memory."""
+
+    def __init__(self, block, **kwargs):
+        super(RecomputeGrad, self).__init__(**kwargs)
+        self.block = block
+
+    def call(self, inputs):
+        return tf.recompute_grad(self.block)(inputs)
+
+
 class RMSNorm(tf.keras.layers.Layer):
     def __init__(self, scale=True, **kwargs):
         super(RMSNorm, self).__init__(**kwargs)
@@ -270,16 +295,54 @@ class RMSNorm(tf.keras.layers.Layer):
 class ApplyAttentionPolicyMap(tf.keras.layers.Layer):
     def __init__(self, **kwargs):
         super(ApplyAttentionPolicyMap, self).__init__(**kwargs)
-        self.fc1 = tf.constant(apm.apm_map)
         self.idx = tf.constant(apm.apm_out, dtype=tf.int32)
 
     def call(self, logits, pp_logits):
         logits = tf.concat([tf.reshape(logits, [-1, 64 * 64]),
                             tf.reshape(pp_logits, [-1, 8 * 24])],
                            axis=1)
-        idx = tf.repeat(tf.reshape(self.idx, [1, -1]), tf.shape(logits)[0], axis=0)
-        return tf.gather(logits, idx, batch_dims=1)
-        return tf.matmul(logits, tf.cast(self.fc1, logits.dtype))
+        return tf.gather(logits, self.idx, axis=1)
+
+
+class PolicyProjections(tf.keras.layers.Layer):
+    """Query and key projections of several attention policy heads, computed
+    with a single matmul. Weights keep the names of the per-head Dense layers
+    so exported nets are unchanged."""
+    def __init__(self, heads, **kwargs):
+        super(PolicyProjections, self).__init__(**kwargs)
+        # list of (head name, depth)
+        self.heads = heads
+
+    def build(self, input_shape):
+        self.kernels = []
+        self.biases = []
+        for head, depth in self.heads:
+            for w in ["wq", "wk"]:
+                self.kernels.append(self.add_weight(
+                    name="{}/attention/{}/kernel".format(head, w),
+                    shape=[input_shape[-1], depth],
+                    initializer="glorot_normal",
+                    trainable=True))
+                self.biases.append(self.add_weight(
+                    name="{}/attention/{}/bias".format(head, w),
+                    shape=[depth],
+                    initializer="zeros",
+                    trainable=True))
+
+    def call(self, x):
+        out = x @ tf.concat(self.kernels, axis=1) + tf.concat(self.biases, axis=0)
+        out = tf.split(out, [depth for _, depth in self.heads for _ in range(2)],
+                       axis=-1)
+        # {head name: (queries, keys)}
+        return {
+            head: (out[2 * i], out[2 * i + 1])
+            for i, (head, _) in enumerate(self.heads)
+        }
+
+    def get_config(self):
+        config = super(PolicyProjections, self).get_config()
+        config.update({'heads': self.heads})
+        return config
 
 
 class RPELogits(tf.keras.layers.Layer):
@@ -287,7 +350,6 @@ class RPELogits(tf.keras.layers.Layer):
         super(RPELogits, self).__init__(**kwargs)
         assert rpe_type in ['q', 'k']
         self.rpe_type = rpe_type
-        self.rpe_factorizer = tf.constant(rpe_map, dtype=self.dtype)
 
 
     def build(self, input_shape):
@@ -301,9 +363,12 @@ class RPELogits(tf.keras.layers.Layer):
                                      trainable=True)
 
     def call(self, x):
-        rpe = self.rpe @ tf.cast(self.rpe_factorizer, x.dtype)
+        rpe = tf.gather(tf.cast(self.rpe, x.dtype), rpe_index, axis=1)
         rpe = tf.reshape(rpe, [self.head_depth, self.head_count, 64, 64])
 
+        # The q and k terms contract over different square indices, so they
+        # cannot share an einsum without materializing a (b, h, 64, 64, d)
+        # tensor.
         if self.rpe_type == 'q':
             out = tf.einsum('bhqd, dhqk->bhqk', x, rpe)
         else:
@@ -320,7 +385,6 @@ class RPEValue(tf.keras.layers.Layer):
     def __init__(self, head_depth,  **kwargs):
         super(RPEValue, self).__init__(**kwargs)
         self.head_depth = head_depth
-        self.rpe_factorizer = tf.constant(rpe_map, dtype=self.dtype)
 
 
     def build(self, input_shape):
@@ -333,7 +397,7 @@ class RPEValue(tf.keras.layers.Layer):
                                      trainable=True)
 
     def call(self, wts):
-        rpe_value = self.rpe_value @ tf.cast(self.rpe_factorizer, wts.dtype)
+        rpe_value = tf.gather(tf.cast(self.rpe_value, wts.dtype), rpe_index, axis=1)
 
         rpe_value = tf.reshape(rpe_value, [self.head_depth, self.head_count, 64, 64])
 
@@ -358,12 +422,13 @@ class Metric:
         self.value = value
         self.count = 1
 
-    def accumulate(self, value):
+    def accumulate(self, value, weight=1):
         if self.count > 0:
-            self.value = self.value + value
-            self.count = self.count + 1
+            self.value = self.value + value * weight
+            self.count = self.count + weight
         else:
-            self.assign(value)
+            self.value = value * weight
+            self.count = weight
 
     def merge(self, other):
         assert self.short_name == other.short_name
@@ -380,9 +445,29 @@ class Metric:
         self.count = 0
 
 
+def summary_writer_property(suffix):
+    return property(lambda self: self.summary_writer(suffix))
+
+
 class TFProcess:
-    def __init__(self, cfg):
+    # train sets up everything, eval skips the optimizer and export also
+    # the losses and metrics and runs on CPU.
+    MODES = ("train", "eval", "export")
+
+    test_writer = summary_writer_property("test")
+    train_writer = summary_writer_property("train")
+    validation_writer = summary_writer_property("validation")
+    swa_writer = summary_writer_property("swa-test")
+    swa_validation_writer = summary_writer_property("swa-validation")
+
+    def __init__(self, cfg, mode="train"):
+        if mode not in self.MODES:
+            raise ValueError("Unknown mode {}, expected one of {}".format(
+                mode, ", ".join(self.MODES)))
+        self.mode = mode
         self.cfg = cfg
+        # Summary writers by suffix, created on first use.
+        self.summary_writers = {}
         self.net = Net()
         self.root_dir = os.path.join(self.cfg["training"]["path"],
                                      self.cfg["name"])
@@ -391,14 +476,33 @@ class TFProcess:
         self.accuracy_thresholds = self.cfg["training"].get(
             "accuracy_thresholds", [1, 2, 5, 10])
 
-        # Sparse training
+        # Sparse training: 2:4 structured sparsity of the encoder kernels,
+        # pruned gradually from sparsity_start_step to sparsity_end_step with
+        # the masks recomputed every sparsity_update_steps, then frozen.
         self.sparse = self.cfg["training"].get("sparse", False)
+        self.sparsity_start_step = self.cfg["training"].get(
+            "sparsity_start_step", 0)
+        self.sparsity_end_step = self.cfg["training"].get(
+            "sparsity_end_step", 0)
+        self.sparsity_update_steps = self.cfg["training"].get(
+            "sparsity_update_steps", 1000)
         self.quantize_activations = self.cfg["model"].get("quantize_activations", False)
         self.quantize_activation_bits= self.cfg["model"].get("quantize_activation_bits", 8)
         self.quantize_weight_bits = self.cfg["model"].get("quantize_weight_bits", 8)
         self.quantize_weights = self.cfg["model"].get("quantize_weights", False)
         self.quantize_channels = self.cfg["model"].get("quantize_channels", False)
         self.rep_quant = self.cfg["model"].get("rep_quant", False)
+        # Export quantized kernels with their quantization applied, as
+        # exact float32 layers.
+        self.export_dequantized = self.cfg["training"].get(
+            "export_dequantized", False)
+        if self.export_dequantized:
+            if not self.quantize_weights:
+                raise ValueError("export_dequantized needs quantize_weights")
+            if self.rep_quant:
+                raise ValueError(
+                    "export_dequantized is not supported with rep_quant")
+        self.net.set_format_from_cfg(self.cfg)
 
 
 
@@ -462,6 +566,11 @@ class TFProcess:
 
 
         self.omit_qkv_biases =  self.cfg["model"].get("omit_qkv_biases", False)
+        # One matmul for the encoder q, k and v projections. Exported nets use
+        # the usual separate fields.
+        self.fused_qkv = self.cfg["model"].get("fused_qkv", False)
+        if self.fused_qkv and self.quantize_weights:
+            raise ValueError("fused_qkv is not supported with quantize_weights")
         self.omit_other_biases = self.cfg["model"].get("omit_other_biases", False)
         self.encoder_rms_norm = self.cfg["model"].get(
             "encoder_rms_norm", False)
@@ -480,11 +589,30 @@ class TFProcess:
             self.model_dtype = tf.float32
         elif precision == "half":
             self.model_dtype = tf.float16
+        elif precision == "bfloat16":
+            self.model_dtype = tf.bfloat16
         else:
             raise ValueError("Unknown precision: {}".format(precision))
 
-        # Scale the loss to prevent gradient underflow
-        self.loss_scale = 1 if self.model_dtype == tf.float32 else loss_scale
+        # Scale the loss to prevent gradient underflow. bfloat16 has the
+        # range of float32 and doesn't need it.
+        self.loss_scale = loss_scale if self.model_dtype == tf.float16 else 1
+
+        # Partition the optimizer slots and gradient accumulators across
+        # replicas instead of keeping full copies on each.
+        self.shard_optimizer_state = self.cfg["training"].get(
+            "shard_optimizer_state", False)
+        if self.shard_optimizer_state and (self.optimizer_name != "nadam"
+                                           or self.loss_scale != 1):
+            raise ValueError(
+                "shard_optimizer_state needs the nadam optimizer and single or bfloat16 precision")
+
+        # Layers whose name matches one of these regexes compute in float32
+        # under half or bfloat16 precision.
+        self.float32_layers = [
+            re.compile(pattern)
+            for pattern in self.cfg["model"].get("float32_layers", [])
+        ]
 
         policy_head = self.cfg['model'].get('policy', 'attention')
         value_head = self.cfg['model'].get('value', 'wdl')
@@ -505,14 +633,10 @@ class TFProcess:
             self.POLICY_HEAD = pb.NetworkFormat.POLICY_CONVOLUTION
         elif policy_head == "attention":
             self.POLICY_HEAD = pb.NetworkFormat.POLICY_ATTENTION
-            if self.encoder_layers > 0:
-                self.net.set_pol_headcount(self.encoder_heads)
         else:
             raise ValueError(
                 "Unknown policy head format: {}".format(policy_head))
 
-        self.net.set_policyformat(self.POLICY_HEAD)
-
         if value_head == "classical":
             self.VALUE_HEAD = pb.NetworkFormat.VALUE_CLASSICAL
             self.wdl = False
@@ -523,8 +647,6 @@ class TFProcess:
             raise ValueError(
                 "Unknown value head format: {}".format(value_head))
 
-        self.net.set_valueformat(self.VALUE_HEAD)
-
         if moves_left_head == "none":
             self.MOVES_LEFT_HEAD = pb.NetworkFormat.MOVES_LEFT_NONE
             self.moves_left = False
@@ -535,8 +657,6 @@ class TFProcess:
             raise ValueError(
                 "Unknown moves left head format: {}".format(moves_left_head))
 
-        self.net.set_movesleftformat(self.MOVES_LEFT_HEAD)
-
         if input_mode == "classic":
             self.INPUT_MODE = pb.NetworkFormat.INPUT_CLASSICAL_112_PLANE
         elif input_mode == "frc_castling":
@@ -555,15 +675,9 @@ class TFProcess:
             raise ValueError(
                 "Unknown input mode format: {}".format(input_mode))
 
-        self.net.set_input(self.INPUT_MODE)
-
         if default_activation == "relu":
-            self.net.set_defaultactivation(
-                pb.NetworkFormat.DEFAULT_ACTIVATION_RELU)
             self.DEFAULT_ACTIVATION = 'relu'
         elif default_activation == "mish":
-            self.net.set_defaultactivation(
-                pb.NetworkFormat.DEFAULT_ACTIVATION_MISH)
             try:
                 self.DEFAULT_ACTIVATION = tf.keras.activations.mish
             except:
@@ -574,25 +688,6 @@ class TFProcess:
             raise ValueError("Unknown default activation type: {}".format(
                 default_activation))
 
-        if self.encoder_layers > 0:
-            self.net.set_headcount(self.encoder_heads)
-            self.net.set_networkformat(
-                pb.NetworkFormat.NETWORK_ATTENTIONBODY_WITH_MULTIHEADFORMAT)
-            self.net.set_smolgen_activation(
-                self.net.activation(self.smolgen_activation))
-            self.net.set_ffn_activation(self.net.activation(
-                'default'))
-
-        if self.embedding_style == "new":
-            self.net.set_input_embedding(
-                pb.NetworkFormat.INPUT_EMBEDDING_PE_DENSE)
-        elif self.encoder_layers > 0:
-            self.net.set_input_embedding(
-                pb.NetworkFormat.INPUT_EMBEDDING_PE_MAP)
-        else:
-            self.net.set_input_embedding(
-                pb.NetworkFormat.INPUT_EMBEDDING_NONE)
-
         self.ffn_activation = self.cfg["model"].get(
             "ffn_activation", self.DEFAULT_ACTIVATION)
 
@@ -607,13 +702,96 @@ class TFProcess:
         # Limit momentum of SWA exponential average to 1 - 1/(swa_max_n + 1)
         self.swa_max_n = self.cfg["training"].get("swa_max_n", 0)
 
+        # Write checkpoints and exported nets from a background thread.
+        self.async_checkpointing = self.cfg["training"].get(
+            "async_checkpointing", False)
+        # Maximum number of pending exports, each holding a host copy of the
+        # weights.
+        self.export_queue_size = self.cfg["training"].get(
+            "export_queue_size", 1)
+
+        # Weight histograms are written on test steps that are a multiple of
+        # histogram_steps (every test step if unset, never if 0), and only
+        # for weights matching one of the histogram_filter regexes.
+        self.histogram_steps = self.cfg["training"].get("histogram_steps")
+        self.histogram_filter = [
+            re.compile(pattern)
+            for pattern in self.cfg["training"].get("histogram_filter", [])
+        ]
+        self.async_summaries = self.cfg["training"].get(
+            "async_summaries", False)
+
+        # Per-step timing breakdown. This synchronizes with the device once
+        # per step, so it is off by default.
+        self.step_timing = self.cfg["training"].get("step_timing", False)
+        self.starvation_warn_fraction = self.cfg["training"].get(
+            "starvation_warn_fraction", 0.1)
+        # ChunkParsers feeding the training set, for shuffle buffer and
+        # worker throughput stats. Set by the caller.
+        self.train_parsers = []
+
         self.renorm_enabled = self.cfg["training"].get("renorm", False)
         self.renorm_max_r = self.cfg["training"].get("renorm_max_r", 1)
         self.renorm_max_d = self.cfg["training"].get("renorm_max_d", 0)
         self.renorm_momentum = self.cfg["training"].get(
             "renorm_momentum", 0.99)
 
-        if self.cfg['gpu'] == 'all':
+        # Activation recomputation: true for every encoder layer, or a list
+        # of 1-based encoder layer indices
+        checkpoint_activations = self.cfg["training"].get(
+            "checkpoint_activations", False)
+        if checkpoint_activations is True:
+            self.checkpointed_layers = set(range(1, self.encoder_layers + 1))
+        elif not checkpoint_activations:
+            self.checkpointed_layers = set()
+        else:
+            self.checkpointed_layers = set(checkpoint_activations)
+        self.checkpoint_embedding_ffn = self.cfg["training"].get(
+            "checkpoint_embedding_ffn", False)
+        if self.checkpointed_layers and (self.return_attn_wts
+                                         or self.return_activations):
+            raise ValueError(
+                "checkpoint_activations cannot be combined with return_attn_wts or return_activations")
+        if self.checkpointed_layers and self.dropout_rate > 0:
+            # The recomputed forward pass would draw new dropout masks, so
+            # the gradients wouldn't match the forward pass.
+            raise ValueError(
+                "checkpoint_activations cannot be combined with dropout_rate > 0")
+
+        # Project queries and keys of all policy heads in one matmul.
+        self.policy_shared_projections = self.cfg["model"].get(
+            "policy_shared_projections", False)
+
+        # Multi-worker training, e.g.
+        # cluster: {workers: ['host1:2222', 'host2:2222'], task_index: 0}
+        # Worker 0 is the chief and the only one writing checkpoints, nets
+        # and logs. Checkpoints must be on a filesystem all workers share.
+        self.cluster = self.cfg.get("cluster") if mode == "train" else None
+        self.is_chief = True
+        if self.mode == "export":
+            # Only weights are read and written, leave the GPUs alone.
+            tf.config.set_visible_devices([], 'GPU')
+            self.strategy = None
+        elif self.cluster is not None:
+            task_index = self.cluster["task_index"]
+            os.environ["TF_CONFIG"] = json.dumps({
+                "cluster": {
+                    "worker": self.cluster["workers"]
+                },
+                "task": {
+                    "type": "worker",
+                    "index": task_index
+                }
+            })
+            gpus = tf.config.experimental.list_physical_devices('GPU')
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(gpu, True)
+            self.strategy = tf.distribute.MultiWorkerMirroredStrategy()
+            tf.distribute.experimental_set_strategy(self.strategy)
+            self.is_chief = task_index == 0
+            self.worker_temp_dir = os.path.join(
+                self.root_dir, "worker-temp-{}".format(task_index))
+        elif self.cfg['gpu'] == 'all':
             gpus = tf.config.experimental.list_physical_devices('GPU')
             for gpu in gpus:
                 tf.config.experimental.set_memory_growth(gpu, True)
@@ -631,13 +809,18 @@ class TFProcess:
         else:
             gpus = tf.config.experimental.list_physical_devices('GPU')
             print(gpus)
-            tf.config.experimental.set_visible_devices(gpus[self.cfg['gpu']],
-                                                       'GPU')
-            tf.config.experimental.set_memory_growth(gpus[self.cfg['gpu']],
-                                                     True)
+            if gpus:
+                tf.config.experimental.set_visible_devices(gpus[self.cfg['gpu']],
+                                                           'GPU')
+                tf.config.experimental.set_memory_growth(gpus[self.cfg['gpu']],
+                                                         True)
+            else:
+                print("No GPU found, running on CPU")
             self.strategy = None
         if self.model_dtype == tf.float16:
             tf.keras.mixed_precision.set_global_policy('mixed_float16')
+        elif self.model_dtype == tf.bfloat16:
+            tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
 
         self.global_step = tf.Variable(0,
                                        name='global_step',
@@ -645,17 +828,9 @@ class TFProcess:
                                        dtype=tf.int64)
 
     def init(self, train_dataset, test_dataset, validation_dataset=None):
-        if self.strategy is not None:
-            self.train_dataset = self.strategy.experimental_distribute_dataset(
-                train_dataset)
-        else:
-            self.train_dataset = train_dataset
+        self.train_dataset = self.distribute_dataset(train_dataset)
         self.train_iter = iter(self.train_dataset)
-        if self.strategy is not None:
-            self.test_dataset = self.strategy.experimental_distribute_dataset(
-                test_dataset)
-        else:
-            self.test_dataset = test_dataset
+        self.test_dataset = self.distribute_dataset(test_dataset)
         self.test_iter = iter(self.test_dataset)
         if self.strategy is not None and validation_dataset is not None:
             self.validation_dataset = self.strategy.experimental_distribute_dataset(
@@ -669,47 +844,118 @@ class TFProcess:
         else:
             self.init_net()
 
-    def init_net(self):
+    def distribute_dataset(self, dataset):
+        """dataset is either a tf.data.Dataset of global batches, or a
+        function taking a tf.distribute.InputContext and returning per-replica
+        batches. The function is called once per replica, or once per worker
+        for multi-worker training."""
+        if not callable(dataset):
+            if self.strategy is None:
+                return dataset
+            return self.strategy.experimental_distribute_dataset(dataset)
+        if self.strategy is None:
+            return dataset(tf.distribute.InputContext())
+        if self.cluster is not None:
+            return self.strategy.distribute_datasets_from_function(dataset)
+        options = tf.distribute.InputOptions(
+            experimental_replication_mode=tf.distribute.InputReplicationMode.
+            PER_REPLICA)
+        return self.strategy.distribute_datasets_from_function(dataset,
+                                                               options=options)
+
+    def build_model(self):
         input_var = tf.keras.Input(shape=(112, 8, 8))
         outputs = self.construct_net(input_var)
-        self.model = tf.keras.Model(inputs=input_var, outputs=outputs)
-
-
-
-
+        return tf.keras.Model(inputs=input_var, outputs=outputs)
 
+    def init_net(self):
+        self.model = self.build_model()
 
 
-        print(f"params: {self.model.count_params()}")
-        smolgen_params = np.sum([K.count_params(w) for w in self.model.trainable_weights if "smol" in w.name])
-        emb_params = np.sum([K.count_params(w) for w in self.model.trainable_weights if "embedding/preprocess" in w.name])
-        rpe_params = np.sum([K.count_params(w) for w in self.model.trainable_weights if "rpe" in w.name])
 
 
-        print(f"smolgen params: {smolgen_params}")
-        print(f"emb preproc params: {emb_params}")
-        print(f"rpe params: {rpe_params}")
 
 
 
+        # Static model statistics, computed once and reused by the summaries.
+        self.model_stats = {
+            "params": self.model.count_params(),
+            "smolgen_params": np.sum([K.count_params(w) for w in self.model.trainable_weights if "smol" in w.name]),
+            "emb_params": np.sum([K.count_params(w) for w in self.model.trainable_weights if "embedding/preprocess" in w.name]),
+            "rpe_params": np.sum([K.count_params(w) for w in self.model.trainable_weights if "rpe" in w.name]),
+            "flops": 0,
+        }
 
-        try:
-            import tensorflow_models as tfm
+        if self.mode == "train":
+            print(f"params: {self.model_stats['params']}")
+            print(f"smolgen params: {self.model_stats['smolgen_params']}")
+            print(f"emb preproc params: {self.model_stats['emb_params']}")
+            print(f"rpe params: {self.model_stats['rpe_params']}")
 
-            flops =  tfm.core.train_utils.try_count_flops(self.model)
-            print(f"FLOPS: {flops / 10 ** 9:.03} G")
-        except:
-            print("won't count flops")
+            # Traces the model, which takes a while for large nets.
+            try:
+                import tensorflow_models as tfm
 
+                flops =  tfm.core.train_utils.try_count_flops(self.model)
+                self.model_stats["flops"] = flops
+                print(f"FLOPS: {flops / 10 ** 9:.03} G")
+            except:
+                # The estimate is informational, it must not stop training.
+                try:
+                    from model_profile import total_flops
+                    flops = total_flops(self.cfg["model"])
+                    self.model_stats["flops"] = flops
+                    print(f"FLOPS (analytic): {flops / 10 ** 9:.03} G")
+                except Exception as e:
+                    print(f"won't count flops: {e}")
+
+        # Training step timings, see report_timing.
+        self.timing_metrics = {
+            "data_wait": Metric("Data", "Timing/Data wait", suffix="s"),
+            "host": Metric("Host", "Timing/Host dispatch", suffix="s"),
+            "device_wait": Metric("Device", "Timing/Device wait", suffix="s"),
+            "step_time": Metric("Step", "Timing/Step", suffix="s"),
+            "test": Metric("Test", "Timing/Test", suffix="s"),
+            "checkpoint": Metric("Ckpt", "Timing/Checkpoint", suffix="s"),
+        }
+        self.last_parser_records = None
+
+        # Masks live on device and are applied as part of apply_grads.
+        self.sparse_weights = []
+        self.sparsity_masks = []
+        self.sparsity_level = tf.Variable(0.,
+                                          name='sparsity_level',
+                                          trainable=False)
+        if self.sparse:
+            for w in self.model.trainable_weights:
+                if self.is_sparse_kernel(w):
+                    self.sparse_weights.append(w)
+                    self.sparsity_masks.append(
+                        tf.Variable(tf.ones_like(w),
+                                    name=w.name.split(":")[0] + "/mask",
+                                    trainable=False))
+            print("Sparse training of {} encoder kernels".format(
+                len(self.sparse_weights)))
+        masks = {
+            w.ref(): mask
+            for w, mask in zip(self.sparse_weights, self.sparsity_masks)
+        }
+        self.trainable_masks = [
+            masks.get(w.ref()) for w in self.model.trainable_weights
+        ]
 
         # swa_count initialized regardless to make checkpoint code simpler.
         self.swa_count = tf.Variable(0., name='swa_count', trainable=False)
+        self.swa_model = None
         self.swa_weights = None
         if self.swa_enabled:
-            # Count of networks accumulated into SWA
-            self.swa_weights = [
-                tf.Variable(w, trainable=False) for w in self.model.weights
-            ]
+            # SWA weights are held in a shadow model so they can be evaluated
+            # and exported directly, without swapping them into self.model.
+            self.swa_model = self.build_model()
+            self.swa_model.trainable = False
+            self.swa_weights = self.swa_model.weights
+            for (swa, w) in zip(self.swa_weights, self.model.weights):
+                swa.assign(w)
 
 
 
@@ -717,6 +963,43 @@ class TFProcess:
         if restore_path is not None:
             self.replace_weights(restore_path, ignore_errors=False)
 
+        if self.mode == "train":
+            self.init_optimizer()
+        if self.mode != "export":
+            self.init_losses()
+        self.time_start = None
+        self.last_steps = None
+
+        # Set adaptive learning rate during training
+        self.cfg["training"]["lr_boundaries"].sort()
+        self.warmup_steps = self.cfg["training"].get("warmup_steps", 0)
+        self.lr = self.cfg["training"]["lr_values"][0]
+        checkpoint_objects = dict(model=self.model,
+                                  global_step=self.global_step,
+                                  swa_count=self.swa_count)
+        if self.mode == "train" and not self.shard_optimizer_state:
+            checkpoint_objects["optimizer"] = self.orig_optimizer
+        if self.sparse:
+            checkpoint_objects["sparsity_level"] = self.sparsity_level
+            checkpoint_objects["sparsity_masks"] = self.sparsity_masks
+        self.checkpoint = tf.train.Checkpoint(**checkpoint_objects)
+        self.checkpoint.listed = self.swa_weights
+        self.manager = tf.train.CheckpointManager(
+            self.checkpoint,
+            directory=self.root_dir if self.is_chief else self.worker_temp_dir,
+            max_to_keep=50,
+            keep_checkpoint_every_n_hours=24,
+            checkpoint_name=self.cfg["name"])
+        self.exporter = None
+        if self.async_checkpointing and self.mode == "train":
+            self.exporter = BackgroundWorker(self.export_queue_size,
+                                             name="exporter")
+        self.summary_writer_thread = None
+        if self.async_summaries and self.mode == "train":
+            self.summary_writer_thread = BackgroundWorker(
+                2, name="summary-writer")
+
+    def init_optimizer(self):
         self.active_lr = tf.Variable(0.000001, trainable=False)
         # All 'new' (TF 2.10 or newer non-legacy) optimizers must have learning_rate updated manually.
         self.update_lr_manually = True
@@ -740,6 +1023,13 @@ class TFProcess:
         elif self.optimizer_name == "rmsprop":
             self.optimizer = tf.keras.optimizers.RMSprop(
                 learning_rate=self.active_lr, rho=0.9, momentum=0.0, epsilon=1e-07, centered=True)
+        elif self.optimizer_name == "nadam" and self.shard_optimizer_state:
+            self.optimizer = ShardedNadam(self.model.trainable_weights,
+                                          learning_rate=self.active_lr,
+                                          beta_1=self.beta_1,
+                                          beta_2=self.beta_2,
+                                          epsilon=self.epsilon,
+                                          masks=self.trainable_masks)
         elif self.optimizer_name == "nadam":
             self.optimizer = tf.keras.optimizers.Nadam(
                 learning_rate=self.active_lr, beta_1=self.beta_1, beta_2=self.beta_2, epsilon=self.epsilon)
@@ -747,14 +1037,16 @@ class TFProcess:
             raise ValueError("Unknown optimizer: " + self.optimizer_name)
 
         self.orig_optimizer = self.optimizer
-        try:
-            self.aggregator = self.orig_optimizer.aggregate_gradients
-        except AttributeError:
-            self.aggregator = self.orig_optimizer.gradient_aggregator
+        if not self.shard_optimizer_state:
+            try:
+                self.aggregator = self.orig_optimizer.aggregate_gradients
+            except AttributeError:
+                self.aggregator = self.orig_optimizer.gradient_aggregator
         if self.loss_scale != 1:
             self.optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
                 self.optimizer, dynamic=True)
 
+    def init_losses(self):
         def split_value_buckets(x, n_buckets=None, lo=-1, hi=1):
             if n_buckets is None:
                 n_buckets = self.categorical_value_buckets
@@ -770,37 +1062,54 @@ class TFProcess:
                 labels=tf.stop_gradient(target), logits=output)
             return tf.reduce_mean(loss)
 
-        def correct_policy(target, output, temperature=1.0):
-            # Calculate loss on policy head
-            if self.cfg["training"].get("mask_legal_moves"):
-                # extract mask for legal moves from target policy
-                move_is_legal = tf.greater_equal(target, 0)
-                # replace logits of illegal moves with large negative value (so that it doesn"t affect policy of legal moves) without gradient
-                illegal_filler = tf.zeros_like(output) - 1.0e10
-                output = tf.where(move_is_legal, output, illegal_filler)
-            # y_ still has -1 on illegal moves, flush them to 0
-            target = tf.pow(tf.nn.relu(target), 1.0 / temperature)
-            # normalize
-            target = target / \
-                tf.reduce_sum(input_tensor=target, axis=1, keepdims=True)
-            return target, output
-
-        def policy_loss(target, output, weights=None, temperature=1.0):
+        def policy_context(target, output, temperature=1.0):
+            """Everything the policy losses and metrics need from one head,
+            computed once per batch."""
+            ctx = {"weights": None}
             if target.dtype == tf.int32:
                 target = tf.one_hot(target, 1858)
-                weights = tf.reduce_sum(target, axis=1, keepdims=False)
+                ctx["weights"] = tf.reduce_sum(target, axis=1, keepdims=False)
                 target = target + (1 - tf.reduce_sum(target, axis=1, keepdims=True)) * (
                     1.0 / 1858)
-
+                move_is_legal = tf.ones_like(target, dtype=tf.bool)
             else:
-                target, output = correct_policy(target, output, temperature)
-            policy_cross_entropy = tf.nn.softmax_cross_entropy_with_logits(
-                labels=tf.stop_gradient(target), logits=output)
+                # extract mask for legal moves from target policy
+                move_is_legal = tf.greater_equal(target, 0)
+                if self.cfg["training"].get("mask_legal_moves"):
+                    # replace logits of illegal moves with large negative value (so that it doesn"t affect policy of legal moves) without gradient
+                    illegal_filler = tf.zeros_like(output) - 1.0e10
+                    output = tf.where(move_is_legal, output, illegal_filler)
+                # y_ still has -1 on illegal moves, flush them to 0
+                target = tf.pow(tf.nn.relu(target), 1.0 / temperature)
+                # normalize
+                target = target / \
+                    tf.reduce_sum(input_tensor=target, axis=1, keepdims=True)
+            target = tf.stop_gradient(target)
+            log_probs = tf.nn.log_softmax(output)
+            ctx.update({
+                "legal": move_is_legal,
+                "target": target,
+                "logits": output,
+                "log_probs": log_probs,
+                "probs": tf.exp(log_probs),
+                "target_move": tf.argmax(input=target, axis=1, output_type=tf.int32),
+                "output_move": tf.argmax(input=output, axis=1, output_type=tf.int32),
+            })
+            return ctx
+
+        self.policy_context_fn = policy_context
+
+        def policy_loss(ctx, weights=None):
+            target = ctx["target"]
+            if weights is None:
+                weights = ctx["weights"]
+            policy_cross_entropy = tf.math.negative(
+                tf.reduce_sum(target * ctx["log_probs"], axis=1))
             target_entropy = tf.math.negative(
                 tf.reduce_sum(tf.math.xlogy(target, target), axis=1))
 
             policy_kld = policy_cross_entropy - target_entropy
-            if weights != None:
+            if weights is not None:
                 policy_kld *= weights
             return tf.reduce_mean(policy_kld)
 
@@ -823,12 +1132,10 @@ class TFProcess:
 
 
 
-        def policy_divergence(y1, y2, target):
-            _, y1 = correct_policy(target, y1)
-            y1 = tf.nn.softmax(y1)
-            _, y2 = correct_policy(target, y2)
-            policy_cross_entropy = tf.nn.softmax_cross_entropy_with_logits(
-                labels=tf.stop_gradient(y1), logits=y2)
+        def policy_divergence(ctx1, ctx2):
+            y1 = tf.stop_gradient(ctx1["probs"])
+            policy_cross_entropy = tf.math.negative(
+                tf.reduce_sum(y1 * ctx2["log_probs"], axis=1))
             y1_entropy = tf.math.negative(
                 tf.reduce_sum(tf.math.xlogy(y1, y1), axis=1))
             policy_kld = policy_cross_entropy - y1_entropy
@@ -849,11 +1156,9 @@ class TFProcess:
 
         self.policy_optimism_weights_fn = get_policy_optimism_weights
 
-        def policy_accuracy(target, output, mask=None):
-            target, output = correct_policy(target, output)
+        def policy_accuracy(ctx, mask=None):
             out = tf.cast(
-                    tf.equal(tf.argmax(input=target, axis=1),
-                             tf.argmax(input=output, axis=1)), tf.float32)
+                    tf.equal(ctx["target_move"], ctx["output_move"]), tf.float32)
             if mask is not None:
                 out = tf.where(mask, out, 0)
             return tf.reduce_mean(out)
@@ -867,9 +1172,8 @@ class TFProcess:
 
         self.moves_left_mean_error = moves_left_mean_error_fn
 
-        def policy_entropy(target, output):
-            target, output = correct_policy(target, output)
-            softmaxed = tf.nn.softmax(output)
+        def policy_entropy(ctx):
+            softmaxed = ctx["probs"]
             return tf.math.negative(
                 tf.reduce_mean(
                     tf.reduce_sum(tf.math.xlogy(softmaxed, softmaxed),
@@ -877,28 +1181,21 @@ class TFProcess:
 
         self.policy_entropy_fn = policy_entropy
 
-        def policy_uniform_loss(target, output):
-            uniform = tf.where(tf.greater_equal(target, 0),
-                               tf.ones_like(target), tf.zeros_like(target))
+        def policy_uniform_loss(ctx):
+            uniform = tf.cast(ctx["legal"], ctx["log_probs"].dtype)
             balanced_uniform = uniform / tf.reduce_sum(
                 uniform, axis=1, keepdims=True)
-            target, output = correct_policy(target, output)
-            policy_cross_entropy = \
-                tf.nn.softmax_cross_entropy_with_logits(labels=tf.stop_gradient(balanced_uniform),
-                                                        logits=output)
+            policy_cross_entropy = tf.math.negative(
+                tf.reduce_sum(balanced_uniform * ctx["log_probs"], axis=1))
             return tf.reduce_mean(input_tensor=policy_cross_entropy)
 
         self.policy_uniform_loss_fn = policy_uniform_loss
 
-        def policy_search_loss(target, output, epsilon=0.003):
-            # output and target both have shape (batch_size, num_outputs)
+        def policy_search_loss(ctx, epsilon=0.003):
             # time to search is roughly 1 / [prediction at best move]
-            target, output = correct_policy(target, output)
-            softmaxed = tf.nn.softmax(output)
-            best_moves = tf.argmax(input=target, axis=1, output_type=tf.int32)
             # output at the best_moves locations
-            output_at_best_moves = tf.gather_nd(softmaxed, tf.stack(
-                [tf.range(tf.shape(output)[0]), best_moves], axis=1))
+            output_at_best_moves = tf.gather(ctx["probs"], ctx["target_move"],
+                                             batch_dims=1)
 
             # estimated search time
             search_time = 1.0 / (output_at_best_moves + epsilon)
@@ -906,7 +1203,7 @@ class TFProcess:
 
         self.policy_search_loss_fn = policy_search_loss
 
-        def policy_thresholded_accuracy(target, output, thresholds=None):
+        def policy_thresholded_accuracy(ctx, thresholds=None):
             # thresholds can be a list of thresholds or a single threshold
             # if no threshold argument defaults to self.accuracy_thresholds
             # Rate at which the best move has policy > threshold%
@@ -917,12 +1214,9 @@ class TFProcess:
             if not thresholds:
                 return []
             thresholds = [threshold / 100 for threshold in thresholds]
-            target, output = correct_policy(target, output)
-            softmaxed = tf.nn.softmax(output)
-            best_moves = tf.argmax(input=target, axis=1, output_type=tf.int32)
             # output at the best_moves locations
-            output_at_best_moves = tf.gather_nd(softmaxed, tf.stack(
-                [tf.range(tf.shape(output)[0]), best_moves], axis=1))
+            output_at_best_moves = tf.gather(ctx["probs"], ctx["target_move"],
+                                             batch_dims=1)
             accuracies = []
             for threshold in thresholds:
                 accuracy = tf.cast(tf.greater(
@@ -1083,8 +1377,6 @@ class TFProcess:
         ]
 
         self.train_metrics.extend(accuracy_thresholded_metrics)
-        self.time_start = None
-        self.last_steps = None
 
         # Order must match the order in calculate_test_summaries_inner_loop
         self.test_metrics = [
@@ -1117,40 +1409,65 @@ class TFProcess:
 
         self.test_metrics.extend(accuracy_thresholded_metrics)
 
-        # Set adaptive learning rate during training
-        self.cfg["training"]["lr_boundaries"].sort()
-        self.warmup_steps = self.cfg["training"].get("warmup_steps", 0)
-        self.lr = self.cfg["training"]["lr_values"][0]
-        self.test_writer = tf.summary.create_file_writer(
+    def flush_exports(self):
+        """Wait for pending background checkpoint, export and summary writes."""
+        if self.exporter is not None:
+            self.exporter.wait()
+        if self.summary_writer_thread is not None:
+            self.summary_writer_thread.wait()
+        if self.async_checkpointing and hasattr(self.checkpoint, "sync"):
+            self.checkpoint.sync()
+
+    def summary_writer(self, suffix):
+        if suffix not in self.summary_writers:
+            self.summary_writers[suffix] = self.create_summary_writer(suffix)
+        return self.summary_writers[suffix]
+
+    def create_summary_writer(self, suffix):
+        if not self.is_chief:
+            return tf.summary.create_noop_writer()
+        return tf.summary.create_file_writer(
             os.path.join(os.getcwd(),
-                         "leelalogs/{}-test".format(self.cfg["name"])))
-        self.train_writer = tf.summary.create_file_writer(
-            os.path.join(os.getcwd(),
-                         "leelalogs/{}-train".format(self.cfg["name"])))
-        if vars(self).get("validation_dataset", None) is not None:
-            self.validation_writer = tf.summary.create_file_writer(
-                os.path.join(
-                    os.getcwd(),
-                    "leelalogs/{}-validation".format(self.cfg["name"])))
-        if self.swa_enabled:
-            self.swa_writer = tf.summary.create_file_writer(
-                os.path.join(os.getcwd(),
-                             "leelalogs/{}-swa-test".format(self.cfg["name"])))
-            self.swa_validation_writer = tf.summary.create_file_writer(
-                os.path.join(
-                    os.getcwd(),
-                    "leelalogs/{}-swa-validation".format(self.cfg["name"])))
-        self.checkpoint = tf.train.Checkpoint(optimizer=self.orig_optimizer,
-                                              model=self.model,
-                                              global_step=self.global_step,
-                                              swa_count=self.swa_count)
-        self.checkpoint.listed = self.swa_weights
-        self.manager = tf.train.CheckpointManager(
-            self.checkpoint,
-            directory=self.root_dir,
-            max_to_keep=50,
-            keep_checkpoint_every_n_hours=24,
-            checkpoint_name=self.cfg["name"])
+                         "leelalogs/{}-{}".format(self.cfg["name"], suffix)))
+
+    def remove_worker_temp_dir(self):
+        # Non-chief workers take part in saving, but into a directory of
+        # their own which is thrown away.
+        if not self.is_chief and tf.io.gfile.exists(self.worker_temp_dir):
+            tf.io.gfile.rmtree(self.worker_temp_dir)
+
+    def save_checkpoint(self, evaled_steps):
+        options = None
+        if self.async_checkpointing and self.is_chief:
+            options = tf.train.CheckpointOptions(
+                experimental_enable_async_checkpoint=True)
+        self.manager.save(checkpoint_number=evaled_steps, options=options)
+        self.remove_worker_temp_dir()
+        if self.shard_optimizer_state:
+            self.optimizer.save_state(
+                self.optimizer_state_path("{}-{}".format(
+                    self.cfg["name"], evaled_steps)))
+            self.remove_stale_optimizer_states()
+
+    def optimizer_state_path(self, checkpoint_name):
+        # Every worker keeps its shards of the sharded optimizer state next
+        # to the chief's checkpoints, non-chief checkpoints are thrown away.
+        task_index = self.cluster["task_index"] if self.cluster else 0
+        return os.path.join(
+            self.root_dir,
+            "{}.optimizer-{}.npz".format(checkpoint_name, task_index))
+
+    def remove_stale_optimizer_states(self):
+        kept = {
+            self.optimizer_state_path(os.path.basename(checkpoint))
+            for checkpoint in self.manager.checkpoints
+        }
+        task_index = self.cluster["task_index"] if self.cluster else 0
+        for path in tf.io.gfile.glob(
+                os.path.join(self.root_dir,
+                             "*.optimizer-{}.npz".format(task_index))):
+            if path not in kept:
+                tf.io.gfile.remove(path)
 
     # False to True is a hack to keep net to model working with atnb
     def replace_weights(self, proto_filename: str, ignore_errors: bool = False):
@@ -1169,6 +1486,8 @@ class TFProcess:
             names.append(weight.name)
 
         new_weights = self.net.get_weights_v2(names)
+        variables = []
+        values = []
         for weight in self.model.weights:
             if "renorm" in weight.name:
                 # Renorm variables are not populated.
@@ -1185,54 +1504,34 @@ class TFProcess:
                 else:
                     raise KeyError(error_string)
 
-            if reduce(operator.mul, weight.shape.as_list(),
-                      1) != len(new_weight):
+            shape = weight.shape.as_list()
+            if reduce(operator.mul, shape, 1) != len(new_weight):
                 error_string = "Tensor {} has wrong length. Tensorflow shape {}, size in protobuf {}".format(
-                    weight.name, weight.shape.as_list(), len(new_weight))
+                    weight.name, shape, len(new_weight))
                 if ignore_errors:
                     print(error_string)
                     continue
                 else:
                     raise KeyError(error_string)
 
-            if weight.shape.ndims == 4:
-                # # Rescale rule50 related weights as clients do not normalize the input.
-                # if weight.name == "input/conv2d/kernel:0" and self.net.pb.format.network_format.input < pb.NetworkFormat.INPUT_112_WITH_CANONICALIZATION_HECTOPLIES:
-                #     num_inputs = 112
-                #     # 50 move rule is the 110th input, or 109 starting from 0.
-                #     rule50_input = 109
-                #     for i in range(len(new_weight)):
-                #         if (i % (num_inputs * 9)) // 9 == rule50_input:
-                #             new_weight[i] = new_weight[i] * 99
-
-                # # Convolution weights need a transpose
-                # #
-                # # TF (kYXInputOutput)
-                # # [filter_height, filter_width, in_channels, out_channels]
-                # #
-                # # Leela/cuDNN/Caffe (kOutputInputYX)
-                # # [output, input, filter_size, filter_size]
-                # s = weight.shape.as_list()
-                # shape = [s[i] for i in [3, 2, 0, 1]]
-                # new_weight = tf.constant(new_weight, shape=shape)
-                # weight.assign(tf.transpose(a=new_weight, perm=[2, 3, 1, 0]))
-                new_weight = tf.constant(new_weight, shape=weight.shape)
-            elif weight.shape.ndims == 2:
+            if weight.shape.ndims == 2:
                 # Fully connected layers are [in, out] in TF
                 #
                 # [out, in] in Leela
                 #
-                s = weight.shape.as_list()
-                shape = [s[i] for i in [1, 0]]
-                new_weight = tf.constant(new_weight, shape=shape)
-                new_weight = tf.transpose(a=new_weight, perm=[1, 0])
+                new_weight = np.reshape(new_weight, shape[::-1]).T
             else:
-                # Biases, batchnorm etc
-                new_weight = tf.constant(new_weight, shape=weight.shape)
-            
-            new_weight = tf.broadcast_to(new_weight, weight.shape)
-            weight.assign(new_weight)
-            
+                # Convolutions (stored in TF order), biases, batchnorm etc
+                new_weight = np.reshape(new_weight, shape)
+            variables.append(weight)
+            values.append(
+                np.ascontiguousarray(new_weight,
+                                     dtype=weight.dtype.as_numpy_dtype))
+
+        assign_weights(variables, values)
+        if self.sparse_weights:
+            self.masks_from_weights()
+
         # Replace the SWA weights as well, ensuring swa accumulation is reset.
         if self.swa_enabled:
             self.swa_count.assign(tf.constant(0.))
@@ -1241,9 +1540,35 @@ class TFProcess:
         # self.save_leelaz_weights("restored.pb.gz")
 
     def restore(self):
-        if self.manager.latest_checkpoint is not None:
-            print("Restoring from {0}".format(self.manager.latest_checkpoint))
-            self.checkpoint.restore(self.manager.latest_checkpoint)
+        if self.is_chief:
+            latest_checkpoint = self.manager.latest_checkpoint
+        else:
+            latest_checkpoint = tf.train.latest_checkpoint(self.root_dir)
+        if latest_checkpoint is not None:
+            print("Restoring from {0}".format(latest_checkpoint))
+            status = self.checkpoint.restore(latest_checkpoint)
+            if self.mode != "train":
+                # The optimizer state isn't needed.
+                status.expect_partial()
+                return
+            try:
+                status.assert_existing_objects_matched()
+            except AssertionError as e:
+                # Recomputed layers are tracked under a RecomputeGrad
+                # wrapper, so their weights have other checkpoint paths.
+                raise ValueError(
+                    "{} doesn't match the model. Was it saved with different "
+                    "checkpoint_activations or checkpoint_embedding_ffn "
+                    "settings?".format(latest_checkpoint)) from e
+            if self.shard_optimizer_state:
+                path = self.optimizer_state_path(
+                    os.path.basename(latest_checkpoint))
+                if not tf.io.gfile.exists(path):
+                    raise ValueError(
+                        "No sharded optimizer state {} for {}, resuming would "
+                        "restart Nadam from zero".format(
+                            path, latest_checkpoint))
+                self.optimizer.restore_state(path)
 
     def process_loop(self, batch_size: int, test_batches: int, batch_splits: int = 1):
         if self.swa_enabled:
@@ -1252,8 +1577,7 @@ class TFProcess:
         # Make sure that ghost batch norm can be applied
         if self.virtual_batch_size and batch_size % self.virtual_batch_size != 0:
             # Adjust required batch size for batch splitting.
-            required_factor = self.virtual_batch_sizes * self.cfg[
-                "training"].get("num_batch_splits", 1)
+            required_factor = self.virtual_batch_size * batch_splits
             raise ValueError(
                 "batch_size must be a multiple of {}".format(required_factor))
 
@@ -1293,11 +1617,12 @@ class TFProcess:
                 try:
                     loop()
                 except tf.errors.ResourceExhaustedError as e:
-                    print("Memory resources exhausted. Try decreasing batch size or model dimension")
+                    print("Memory resources exhausted. Try decreasing batch size or model dimension, or set num_batch_splits: auto")
                     print("Saving model...")
                     steps = self.global_step.read_value()
                     evaled_steps = steps.numpy()
-                    self.manager.save(checkpoint_number=evaled_steps)
+                    self.flush_exports()
+                    self.save_checkpoint(evaled_steps)
                     print("Model saved in file: {}".format(
                         self.manager.latest_checkpoint))
                     exit()
@@ -1306,10 +1631,8 @@ class TFProcess:
             print("Warning, rich module not found, disabling progress bar")
             loop()
 
+        self.flush_exports()
 
-    @tf.function()
-    def read_weights(self):
-        return [w.read_value() for w in self.model.weights]
 
     @tf.function()
     def process_inner_loop(self, x, y, z, q, m, st_q, opp_idx, next_idx):
@@ -1334,26 +1657,30 @@ class TFProcess:
             policy_next = outputs.get("policy_next")
 
             # Policy losses
-            policy_loss = self.policy_loss_fn(y, policy)
-            policy_accuracy = self.policy_accuracy_fn(y, policy)
-            policy_entropy = self.policy_entropy_fn(y, policy)
-            policy_ul = self.policy_uniform_loss_fn(y, policy)
-            policy_sl = self.policy_search_loss_fn(y, policy)
+            policy_ctx = self.policy_context_fn(y, policy)
+            policy_loss = self.policy_loss_fn(policy_ctx)
+            policy_accuracy = self.policy_accuracy_fn(policy_ctx)
+            policy_entropy = self.policy_entropy_fn(policy_ctx)
+            policy_ul = self.policy_uniform_loss_fn(policy_ctx)
+            policy_sl = self.policy_search_loss_fn(policy_ctx)
             policy_thresholded_accuracies = self.policy_thresholded_accuracy_fn(
-                y, policy)
+                policy_ctx)
             if policy_optimistic_st is not None:
                 optimism_weights = self.policy_optimism_weights_fn(
                     st_q, value_st, value_st_err)
+                policy_optimistic_st_ctx = self.policy_context_fn(
+                    y, policy_optimistic_st)
                 policy_optimistic_st_loss = self.policy_loss_fn(
-                    y, policy_optimistic_st, weights=optimism_weights)
+                    policy_optimistic_st_ctx, weights=optimism_weights)
                 policy_optimistic_st_divergence = self.policy_divergence_fn(
-                    policy, policy_optimistic_st, y)
+                    policy_ctx, policy_optimistic_st_ctx)
             else:
                 policy_optimistic_st_loss = tf.constant(0.)
                 policy_optimistic_st_divergence = tf.constant(0.)
             if policy_soft is not None:
                 policy_soft_loss = self.policy_loss_fn(
-                    y, policy_soft, temperature=self.soft_policy_temperature)
+                    self.policy_context_fn(
+                        y, policy_soft, temperature=self.soft_policy_temperature))
             else:
                 policy_soft_loss = tf.constant(0.)
 
@@ -1448,29 +1775,66 @@ class TFProcess:
         return metrics, new_grads
 
     @tf.function()
-    def apply_grads(self, grads, effective_batch_splits):
+    def apply_grads(self, grads, effective_batch_splits, update_ratios=False):
+        max_grad_norm = self.cfg['training'].get(
+            'max_grad_norm', 10000.0) * effective_batch_splits
+        if update_ratios:
+            # Only kept for the duration of this step, on device.
+            before_weights = [
+                w.read_value() for w in self.model.trainable_weights
+            ]
+        if self.shard_optimizer_state:
+            # The gradients are already in the optimizer's accumulators.
+            grad_norm = self.optimizer.apply_accumulated(max_grad_norm)
+        else:
+            grad_norm = self.apply_full_grads(grads, max_grad_norm)
+        if self.sparse_weights:
+            self.apply_sparsity_masks()
+        if update_ratios:
+            return grad_norm, self.weight_update_ratios(before_weights)
+        return grad_norm, tf.zeros([0])
+
+    def apply_full_grads(self, grads, max_grad_norm):
         grads = [
             g[0]
             for g in self.aggregator(zip(grads, self.model.trainable_weights))
         ]
         if self.loss_scale != 1:
             grads = self.optimizer.get_unscaled_gradients(grads)
-        max_grad_norm = self.cfg['training'].get(
-            'max_grad_norm', 10000.0) * effective_batch_splits
         grads, grad_norm = tf.clip_by_global_norm(grads, max_grad_norm)
+        # Pruned weights get no gradient, so no optimizer momentum either.
+        grads = [
+            g if mask is None else g * mask
+            for g, mask in zip(grads, self.trainable_masks)
+        ]
         self.optimizer.apply_gradients(zip(grads,
                                            self.model.trainable_weights),
                                        experimental_aggregate_gradients=False)
         return grad_norm
 
+    def weight_update_ratios(self, before_weights):
+        # Norm of the applied update relative to the weight norm, -1 for
+        # weights that are all zero.
+        ratios = []
+        for before, w in zip(before_weights, self.model.trainable_weights):
+            delta_norm = tf.math.reduce_euclidean_norm(w.read_value() - before)
+            weight_norm = tf.math.reduce_euclidean_norm(before)
+            ratios.append(
+                tf.where(weight_norm != 0., delta_norm / weight_norm, -1.))
+        return tf.stack(ratios)
+
     @tf.function()
-    def strategy_apply_grads(self, grads, effective_batch_splits: int):
-        grad_norm = self.strategy.run(self.apply_grads,
-                                      args=(grads, effective_batch_splits))
+    def strategy_apply_grads(self, grads, effective_batch_splits: int, update_ratios=False):
+        grad_norm, ratios = self.strategy.run(
+            self.apply_grads,
+            args=(grads, effective_batch_splits, update_ratios))
         grad_norm = self.strategy.reduce(tf.distribute.ReduceOp.MEAN,
                                          grad_norm,
                                          axis=None)
-        return grad_norm
+        ratios = self.strategy.reduce(tf.distribute.ReduceOp.MEAN,
+                                      ratios,
+                                      axis=None)
+        return grad_norm, ratios
 
     @tf.function()
     def merge_grads(self, grads, new_grads):
@@ -1480,27 +1844,49 @@ class TFProcess:
     def strategy_merge_grads(self, grads, new_grads):
         return self.strategy.run(self.merge_grads, args=(grads, new_grads))
 
+    @tf.function()
+    def accumulate_grads(self, new_grads):
+        self.optimizer.accumulate(new_grads)
+
+    @tf.function()
+    def strategy_accumulate_grads(self, new_grads):
+        self.strategy.run(self.accumulate_grads, args=(new_grads, ))
+
 
     def train_step(self, steps: int, batch_size: int, batch_splits: int):
         # need to add 1 to steps because steps will be incremented after gradient update
-        if (steps +
+        report = bool((steps +
                 1) % self.cfg["training"]["train_avg_report_steps"] == 0 or (
-                    steps + 1) % self.cfg["training"]["total_steps"] == 0:
-            before_weights = self.read_weights()
+                    steps + 1) % self.cfg["training"]["total_steps"] == 0)
 
+        if self.step_timing:
+            step_start = time.perf_counter()
+            data_wait = 0.0
 
+        if self.sparse:
+            self.maybe_update_sparsity(int(steps))
 
         # Run training for this batch
         grads = None
         for batch_id in range(batch_splits):
+            if self.step_timing:
+                wait_start = time.perf_counter()
             x, y, z, q, m, st_q, opp_idx, next_idx = next(self.train_iter)
+            if self.step_timing:
+                data_wait += time.perf_counter() - wait_start
             if self.strategy is not None:
                 metrics, new_grads = self.strategy_process_inner_loop(
                     x, y, z, q, m, st_q, opp_idx, next_idx)
             else:
                 metrics, new_grads = self.process_inner_loop(
                     x, y, z, q, m, st_q, opp_idx, next_idx)
-            if not grads:
+            if self.shard_optimizer_state:
+                # Only this replica's shard of the summed gradients is kept.
+                if self.strategy is not None:
+                    self.strategy_accumulate_grads(new_grads)
+                else:
+                    self.accumulate_grads(new_grads)
+            elif not grads:
                 grads = new_grads
             else:
                 if self.strategy is not None:
@@ -1522,10 +1908,24 @@ class TFProcess:
         if self.update_lr_manually:
             self.orig_optimizer.learning_rate = self.active_lr
         if self.strategy is not None:
-            grad_norm = self.strategy_apply_grads(grads,
-                                                  effective_batch_splits)
+            grad_norm, update_ratios = self.strategy_apply_grads(
+                grads, effective_batch_splits, report)
         else:
-            grad_norm = self.apply_grads(grads, effective_batch_splits)
+            grad_norm, update_ratios = self.apply_grads(
+                grads, effective_batch_splits, report)
+
+        if self.step_timing:
+            # Work is dispatched asynchronously, so host time is measured up
+            # to the point everything has been queued and device wait is
+            # the remainder until the update has actually finished.
+            dispatched = time.perf_counter()
+            grad_norm.numpy()
+            done = time.perf_counter()
+            self.timing_metrics["data_wait"].accumulate(data_wait)
+            self.timing_metrics["host"].accumulate(dispatched - step_start -
+                                                   data_wait)
+            self.timing_metrics["device_wait"].accumulate(done - dispatched)
+            self.timing_metrics["step_time"].accumulate(done - step_start)
 
         # Note: grads variable at this point has not been unscaled or
         # had clipping applied. Since no code after this point depends
@@ -1542,6 +1942,7 @@ class TFProcess:
                     "total_steps"] == 0:
             time_end = time.time()
             speed = 0
+            elapsed = None
             if self.time_start:
                 elapsed = time_end - self.time_start
                 steps_elapsed = steps - self.last_steps
@@ -1558,7 +1959,6 @@ class TFProcess:
                           metric.get(), metric.suffix)
             print(" ({:g} pos/s)".format(speed))
 
-            after_weights = self.read_weights()
             with self.train_writer.as_default():
                 for metric in self.train_metrics:
                     tf.summary.scalar(metric.long_name,
@@ -1568,7 +1968,9 @@ class TFProcess:
                 tf.summary.scalar("Gradient norm",
                                   grad_norm / effective_batch_splits,
                                   step=steps)
-                self.compute_update_ratio(before_weights, after_weights, steps)
+                self.compute_update_ratio(update_ratios, steps)
+                if self.step_timing:
+                    self.report_timing(steps, elapsed)
             self.train_writer.flush()
 
             self.time_start = time_end
@@ -1576,11 +1978,6 @@ class TFProcess:
             for metric in self.train_metrics:
                 metric.reset()
 
-        if self.sparse:  # !!!
-            if not hasattr(self, "sparsity_patterns"):
-                self.set_sparsity_patterns()
-            self.apply_sparsity()
-
         return steps
 
     def process(self, batch_size: int, test_batches: int, batch_splits: int):
@@ -1624,10 +2021,13 @@ class TFProcess:
         # one at the final step so the delta to the first step can be calculated.
         if steps % self.cfg["training"]["test_steps"] == 0 or steps % self.cfg[
                 "training"]["total_steps"] == 0:
+            test_start = time.perf_counter()
             with tf.profiler.experimental.Trace("Test", step_num=steps):
                 self.calculate_test_summaries(test_batches, steps)
                 if self.swa_enabled:
                     self.calculate_swa_summaries(test_batches, steps)
+            self.timing_metrics["test"].accumulate(time.perf_counter() -
+                                                   test_start)
 
         if self.validation_dataset is not None and (
                 steps % self.cfg["training"]["validation_steps"] == 0
@@ -1642,11 +2042,11 @@ class TFProcess:
                 "checkpoint_steps" in self.cfg["training"]
                 and steps % self.cfg["training"]["checkpoint_steps"] == 0):
             if True:
-
+                checkpoint_start = time.perf_counter()
 
                 # Checkpoint the model weights.
                 evaled_steps = steps.numpy()
-                self.manager.save(checkpoint_number=evaled_steps)
+                self.save_checkpoint(evaled_steps)
                 print("Model saved in file: {}".format(
                     self.manager.latest_checkpoint))
 
@@ -1655,20 +2055,31 @@ class TFProcess:
                 swa_path = path + "-swa-" + str(evaled_steps)
                 self.net.pb.training_params.training_steps = evaled_steps
 
-                backup = self.read_weights()
-                for (swa, w) in zip(self.swa_weights, self.model.weights):
-                    w.assign(swa.read_value())
-                tf.saved_model.save(self.model, swa_path)
-                for (old, w) in zip(backup, self.model.weights):
-                    w.assign(old)
+                if self.swa_enabled and not self.is_chief:
+                    tf.saved_model.save(self.swa_model, self.worker_temp_dir)
+                    self.remove_worker_temp_dir()
+                elif self.swa_enabled:
+                    # Saving traces the live model, so it can't overlap with
+                    # training steps updating the same variables.
+                    tf.saved_model.save(self.swa_model, swa_path)
 
 
 
-                if not self.cfg["training"].get("disable_pb_checkpointing"):
+                if self.is_chief and not self.cfg["training"].get("disable_pb_checkpointing"):
                     
                     #self.save_leelaz_weights(leela_path)
                     if self.swa_enabled:
-                        self.save_swa_weights(swa_path)
+                        if self.exporter is not None:
+                            # Snapshot to host now, quantize and gzip later.
+                            net = self.copy_net()
+                            numpy_weights = self.read_numpy_weights(
+                                self.swa_model)
+                            self.exporter.submit(self.write_leelaz_weights,
+                                                 net, numpy_weights, swa_path)
+                        else:
+                            self.save_swa_weights(swa_path)
+                self.timing_metrics["checkpoint"].accumulate(
+                    time.perf_counter() - checkpoint_start)
 
         if self.profiling_start_step is not None and (
                 steps >= self.profiling_start_step +
@@ -1678,19 +2089,16 @@ class TFProcess:
             self.profiling_start_step = None
 
     def calculate_swa_summaries(self, test_batches: int, steps: int):
-        backup = self.read_weights()
-        for (swa, w) in zip(self.swa_weights, self.model.weights):
-            w.assign(swa.read_value())
-        true_test_writer, self.test_writer = self.test_writer, self.swa_writer
         print("swa", end=" ")
-        self.calculate_test_summaries(test_batches, steps)
-        self.test_writer = true_test_writer
-        for (old, w) in zip(backup, self.model.weights):
-            w.assign(old)
+        self.calculate_test_summaries(test_batches, steps,
+                                      model=self.swa_model,
+                                      writer=self.swa_writer)
 
     @tf.function()
-    def calculate_test_summaries_inner_loop(self, x, y, z, q, m, st_q, opp_idx, next_idx):
-        outputs = self.model(x, training=False)
+    def calculate_test_summaries_inner_loop(self, x, y, z, q, m, st_q, opp_idx, next_idx, model=None):
+        if model is None:
+            model = self.model
+        outputs = model(x, training=False)
 
         value_winner = outputs.get("value_winner")
         value_winner_err = None
@@ -1709,8 +2117,9 @@ class TFProcess:
         policy_next = outputs.get("policy_next")
 
         # Policy losses
-        policy_loss = self.policy_loss_fn(y, policy)
-        policy_accuracy = self.policy_accuracy_fn(y, policy)
+        policy_ctx = self.policy_context_fn(y, policy)
+        policy_loss = self.policy_loss_fn(policy_ctx)
+        policy_accuracy = self.policy_accuracy_fn(policy_ctx)
 
 
         major_piece_counts = count_major_pieces(x)
@@ -1718,30 +2127,33 @@ class TFProcess:
         middlegame_mask = tf.logical_and(tf.math.greater_equal(major_piece_counts, 7), tf.math.less_equal(major_piece_counts, 10))
         opening_mask = tf.logical_and(tf.math.greater_equal(major_piece_counts, 11), tf.math.less_equal(major_piece_counts, 14))
         # thresholds for early, middle, endgame are 13-14, 7-12, 0-6
-        opening_policy_accuracy = self.policy_accuracy_fn(y, policy, mask=opening_mask)
+        opening_policy_accuracy = self.policy_accuracy_fn(policy_ctx, mask=opening_mask)
 
-        middlegame_policy_accuracy = self.policy_accuracy_fn(y, policy, mask=middlegame_mask)
-        endgame_policy_accuracy = self.policy_accuracy_fn(y, policy, mask=endgame_mask)
+        middlegame_policy_accuracy = self.policy_accuracy_fn(policy_ctx, mask=middlegame_mask)
+        endgame_policy_accuracy = self.policy_accuracy_fn(policy_ctx, mask=endgame_mask)
 
 
-        policy_entropy = self.policy_entropy_fn(y, policy)
-        policy_ul = self.policy_uniform_loss_fn(y, policy)
-        policy_sl = self.policy_search_loss_fn(y, policy)
+        policy_entropy = self.policy_entropy_fn(policy_ctx)
+        policy_ul = self.policy_uniform_loss_fn(policy_ctx)
+        policy_sl = self.policy_search_loss_fn(policy_ctx)
         policy_thresholded_accuracies = self.policy_thresholded_accuracy_fn(
-            y, policy)
+            policy_ctx)
         if policy_optimistic_st is not None:
             optimism_weights = self.policy_optimism_weights_fn(
                 st_q, value_st, value_st_err)
+            policy_optimistic_st_ctx = self.policy_context_fn(
+                y, policy_optimistic_st)
             policy_optimistic_st_loss = self.policy_loss_fn(
-                y, policy_optimistic_st, weights=optimism_weights)
+                policy_optimistic_st_ctx, weights=optimism_weights)
             policy_optimistic_st_divergence = self.policy_divergence_fn(
-                policy, policy_optimistic_st, y)
+                policy_ctx, policy_optimistic_st_ctx)
         else:
             policy_optimistic_st_loss = tf.constant(0.)
             policy_optimistic_st_divergence = tf.constant(0.)
         if policy_soft is not None:
             policy_soft_loss = self.policy_loss_fn(
-                y, policy_soft, temperature=self.soft_policy_temperature)
+                self.policy_context_fn(
+                    y, policy_soft, temperature=self.soft_policy_temperature))
         else:
             policy_soft_loss = tf.constant(0.)
         policy_opponent_loss = self.future_loss_fn(
@@ -1805,26 +2217,51 @@ class TFProcess:
         return metrics
 
     @tf.function()
-    def strategy_calculate_test_summaries_inner_loop(self, x, y, z, q, m, st_q, opp_idx, next_idx):
+    def strategy_calculate_test_summaries_inner_loop(self, x, y, z, q, m, st_q, opp_idx, next_idx, model=None):
         metrics = self.strategy.run(self.calculate_test_summaries_inner_loop,
-                                    args=(x, y, z, q, m, st_q, opp_idx, next_idx))
+                                    args=(x, y, z, q, m, st_q, opp_idx, next_idx),
+                                    kwargs={"model": model})
         metrics = [
             self.strategy.reduce(tf.distribute.ReduceOp.MEAN, m, axis=None)
             for m in metrics
         ]
         return metrics
 
-    def calculate_test_summaries(self, test_batches: int, steps: int):
+    @tf.function()
+    def calculate_test_summaries_models_inner_loop(self, x, y, z, q, m, st_q, opp_idx, next_idx, models):
+        # Every model in one graph, the batch is transferred once.
+        return [
+            self.calculate_test_summaries_inner_loop(
+                x, y, z, q, m, st_q, opp_idx, next_idx, model=model)
+            for model in models
+        ]
+
+    @tf.function()
+    def strategy_calculate_test_summaries_models_inner_loop(self, x, y, z, q, m, st_q, opp_idx, next_idx, models):
+        results = self.strategy.run(
+            self.calculate_test_summaries_models_inner_loop,
+            args=(x, y, z, q, m, st_q, opp_idx, next_idx),
+            kwargs={"models": models})
+        return [[
+            self.strategy.reduce(tf.distribute.ReduceOp.MEAN, m, axis=None)
+            for m in metrics
+        ] for metrics in results]
+
+    def calculate_test_summaries(self, test_batches: int, steps: int, model=None, writer=None):
+        if model is None:
+            model = self.model
+        if writer is None:
+            writer = self.test_writer
         for metric in self.test_metrics:
             metric.reset()
         for _ in range(0, test_batches):
             x, y, z, q, m, st_q, opp_idx, next_idx = next(self.test_iter)
             if self.strategy is not None:
                 metrics = self.strategy_calculate_test_summaries_inner_loop(
-                    x, y, z, q, m, st_q, opp_idx, next_idx)
+                    x, y, z, q, m, st_q, opp_idx, next_idx, model=model)
             else:
                 metrics = self.calculate_test_summaries_inner_loop(
-                    x, y, z, q, m, st_q, opp_idx, next_idx)
+                    x, y, z, q, m, st_q, opp_idx, next_idx, model=model)
             for acc, val in zip(self.test_metrics, metrics):
                 acc.accumulate(val)
         self.net.pb.training_params.learning_rate = self.lr
@@ -1832,30 +2269,22 @@ class TFProcess:
         self.net.pb.training_params.policy_loss = self.test_metrics[0].get()
         # TODO store value and value accuracy in pb
         self.net.pb.training_params.accuracy = self.test_metrics[4].get()
-        with self.test_writer.as_default():
-            for metric in self.test_metrics:
-                tf.summary.scalar(metric.long_name, metric.get(), step=steps)
-            for w in self.model.weights:
-                tf.summary.histogram(w.name, w, step=steps)
-            params = self.model.count_params()
-            smolgen_params = np.sum([K.count_params(w) for w in self.model.trainable_weights if "smol" in w.name])
-            emb_params = np.sum([K.count_params(w) for w in self.model.trainable_weights if "embedding/preprocess" in w.name])
-            rpe_params = np.sum([K.count_params(w) for w in self.model.trainable_weights if "rpe" in w.name])
-
-            try:
-                import tensorflow_models as tfm
-
-                flops =  tfm.core.train_utils.try_count_flops(self.model)
-            except:
-                flops = 0
-            if steps == 1:
-                tf.summary.text("Params", str(params), step=steps)
-                tf.summary.text("Smolgen params", str(smolgen_params), step=steps)
-                tf.summary.text("Embedding params", str(emb_params), step=steps)
-                tf.summary.text("FLOPS", str(flops), step=steps)
 
-
-        self.test_writer.flush()
+        steps = int(steps)
+        scalars = [(metric.long_name, float(metric.get()))
+                   for metric in self.test_metrics]
+        histograms = []
+        if self.histogram_steps is None or (self.histogram_steps > 0 and
+                                            steps % self.histogram_steps == 0):
+            histograms = [(w.name, w.numpy() if self.async_summaries else w)
+                          for w in model.weights
+                          if self.histogram_wanted(w.name)]
+        if self.summary_writer_thread is not None:
+            self.summary_writer_thread.submit(self.write_test_summaries,
+                                              writer, steps, scalars,
+                                              histograms)
+        else:
+            self.write_test_summaries(writer, steps, scalars, histograms)
 
         print("step {},".format(steps), end="")
         for metric in self.test_metrics:
@@ -1864,34 +2293,41 @@ class TFProcess:
                   end="")
         print()
 
+    def histogram_wanted(self, name):
+        if not self.histogram_filter:
+            return True
+        return any(pattern.search(name) for pattern in self.histogram_filter)
+
+    def write_test_summaries(self, writer, steps: int, scalars, histograms):
+        with writer.as_default():
+            for name, value in scalars:
+                tf.summary.scalar(name, value, step=steps)
+            for name, value in histograms:
+                tf.summary.histogram(name, value, step=steps)
+            if steps == 1:
+                tf.summary.text("Params", str(self.model_stats["params"]), step=steps)
+                tf.summary.text("Smolgen params", str(self.model_stats["smolgen_params"]), step=steps)
+                tf.summary.text("Embedding params", str(self.model_stats["emb_params"]), step=steps)
+                tf.summary.text("FLOPS", str(self.model_stats["flops"]), step=steps)
+        writer.flush()
+
     def calculate_swa_validations(self, steps: int):
-        backup = self.read_weights()
-        for (swa, w) in zip(self.swa_weights, self.model.weights):
-            w.assign(swa.read_value())
-        true_validation_writer, self.validation_writer = self.validation_writer, self.swa_validation_writer
         print("swa", end=" ")
-        self.calculate_test_validations(steps)
-        self.validation_writer = true_validation_writer
-        for (old, w) in zip(backup, self.model.weights):
-            w.assign(old)
-
-    def calculate_test_validations(self, steps: int):
+        self.calculate_test_validations(steps,
+                                        model=self.swa_model,
+                                        writer=self.swa_validation_writer)
+
+    def calculate_test_validations(self, steps: int, model=None, writer=None):
+        if model is None:
+            model = self.model
+        if writer is None:
+            writer = self.validation_writer
         print("logging test validations")
-        for metric in self.test_metrics:
-            metric.reset()
-        for (x, y, z, q, m, st_q, opp_idx, next_idx) in self.validation_dataset:
-            if self.strategy is not None:
-                metrics = self.strategy_calculate_test_summaries_inner_loop(
-                    x, y, z, q, m, st_q, opp_idx, next_idx)
-            else:
-                metrics = self.calculate_test_summaries_inner_loop(
-                    x, y, z, q, m, st_q, opp_idx, next_idx)
-            for acc, val in zip(self.test_metrics, metrics):
-                acc.accumulate(val)
-        with self.validation_writer.as_default():
+        self.evaluate_dataset(self.validation_dataset, model=model)
+        with writer.as_default():
             for metric in self.test_metrics:
                 tf.summary.scalar(metric.long_name, metric.get(), step=steps)
-        self.validation_writer.flush()
+        writer.flush()
 
         print("step {}, validation:".format(steps), end="")
         for metric in self.test_metrics:
@@ -1900,57 +2336,146 @@ class TFProcess:
                   end="")
         print()
 
+    def evaluate_dataset(self, dataset, model=None):
+        """Average test_metrics over one pass of a (distributed) dataset,
+        weighting batches by their size. Returns the number of positions."""
+        if model is None:
+            model = self.model
+        return self.evaluate_models(dataset, [model], [self.test_metrics])
+
+    def evaluate_models(self, dataset, models, metric_lists, stacked=False):
+        """Like evaluate_dataset for several models, each batch is decoded
+        once and run through all of them. The metrics of models[i] go to
+        metric_lists[i]. Stacked runs all models in one function call per
+        batch instead of one call per model."""
+        for metrics in metric_lists:
+            for metric in metrics:
+                metric.reset()
+        positions = 0
+        for batch in dataset:
+            if stacked and self.strategy is not None:
+                results = self.strategy_calculate_test_summaries_models_inner_loop(
+                    *batch, models=models)
+            elif stacked:
+                results = self.calculate_test_summaries_models_inner_loop(
+                    *batch, models=models)
+            elif self.strategy is not None:
+                results = [
+                    self.strategy_calculate_test_summaries_inner_loop(
+                        *batch, model=model) for model in models
+                ]
+            else:
+                results = [
+                    self.calculate_test_summaries_inner_loop(*batch,
+                                                             model=model)
+                    for model in models
+                ]
+            if self.strategy is not None:
+                batch_size = sum(
+                    int(t.shape[0])
+                    for t in self.strategy.experimental_local_results(batch[0]))
+            else:
+                batch_size = int(batch[0].shape[0])
+            for metrics, values in zip(metric_lists, results):
+                for acc, val in zip(metrics, values):
+                    acc.accumulate(val, batch_size)
+            positions += batch_size
+        return positions
+
+    def report_timing(self, steps, elapsed):
+        """Write the averaged step timing and input pipeline stats since the
+        last report to TensorBoard and the timing JSON-lines file."""
+        steps = int(steps)
+        record = {"step": steps}
+        for key, metric in self.timing_metrics.items():
+            if metric.count > 0:
+                record[key] = float(metric.get())
+                tf.summary.scalar(metric.long_name, record[key], step=steps)
+            metric.reset()
+
+        parser_stats = [parser.stats() for parser in self.train_parsers]
+        if parser_stats:
+            record["shuffle_fill"] = float(
+                np.mean([st["shuffle_fill"] for st in parser_stats]))
+            tf.summary.scalar("Timing/Shuffle buffer fill",
+                              record["shuffle_fill"],
+                              step=steps)
+            records = [n for st in parser_stats for n in st["worker_records"]]
+            if (elapsed and self.last_parser_records is not None
+                    and len(records) == len(self.last_parser_records)):
+                rates = [(n - last) / elapsed for n, last in zip(
+                    records, self.last_parser_records)]
+                record["worker_records_per_s"] = rates
+                tf.summary.scalar("Timing/Records per s", sum(rates), step=steps)
+                tf.summary.histogram("Timing/Worker records per s",
+                                     rates,
+                                     step=steps)
+            self.last_parser_records = records
+
+        if self.is_chief:
+            with open(
+                    os.path.join(os.getcwd(), "leelalogs/{}-timing.jsonl".format(
+                        self.cfg["name"])), "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        if record.get("step_time", 0) > 0 and "data_wait" in record:
+            starved = record["data_wait"] / record["step_time"]
+            if starved > self.starvation_warn_fraction:
+                fill = record.get("shuffle_fill")
+                print("Input bound: {:.0%} of step time waiting for data{}".
+                      format(starved, "" if fill is None else
+                             ", shuffle buffer {:.0%} full".format(fill)))
+
     @tf.function()
-    def compute_update_ratio(self, before_weights, after_weights, steps: int):
-        """Compute the ratio of gradient norm to weight norm.
+    def compute_update_ratio(self, ratios, steps: int):
+        """Write the ratio of update norm to weight norm per trainable weight.
 
+        The ratios themselves are computed on device in apply_grads.
         Adapted from https://github.com/tensorflow/minigo/blob/c923cd5b11f7d417c9541ad61414bf175a84dc31/dual_net.py#L567
         """
-        deltas = [
-            after - before
-            for after, before in zip(after_weights, before_weights)
-        ]
-        delta_norms = [tf.math.reduce_euclidean_norm(d) for d in deltas]
-        weight_norms = [
-            tf.math.reduce_euclidean_norm(w) for w in before_weights
-        ]
-        ratios = [(tensor.name, tf.cond(w != 0., lambda: d / w, lambda: -1.))
-                  for d, w, tensor in zip(delta_norms, weight_norms,
-                                          self.model.weights)
-                  if not "moving" in tensor.name]
-        for name, ratio in ratios:
-            tf.summary.scalar("update_ratios/" + name, ratio, step=steps)
+        for i, tensor in enumerate(self.model.trainable_weights):
+            tf.summary.scalar("update_ratios/" + tensor.name, ratios[i], step=steps)
         # Filtering is hard, so just push infinities/NaNs to an unreasonably large value.
-        ratios = [
-            tf.cond(r > 0, lambda: tf.math.log(r) / 2.30258509299,
-                    lambda: 200.) for (_, r) in ratios
-        ]
+        log_ratios = tf.where(ratios > 0, tf.math.log(ratios) / 2.30258509299,
+                              200.)
         tf.summary.histogram("update_ratios_log10",
-                             tf.stack(ratios),
+                             log_ratios,
                              buckets=1000,
                              step=steps)
 
+    @tf.function()
     def update_swa(self):
         num = self.swa_count.read_value()
         for (w, swa) in zip(self.model.weights, self.swa_weights):
             swa.assign(swa.read_value() * (num / (num + 1.)) + w.read_value() *
                        (1. / (num + 1.)))
-        self.swa_count.assign(min(num + 1., self.swa_max_n))
+        self.swa_count.assign(tf.minimum(num + 1., self.swa_max_n))
 
     def save_swa_weights(self, filename: str):
-        backup = self.read_weights()
-        for (swa, w) in zip(self.swa_weights, self.model.weights):
-            w.assign(swa.read_value())
-        self.save_leelaz_weights(filename)
-        for (old, w) in zip(backup, self.model.weights):
-            w.assign(old)
-
-    def save_leelaz_weights(self, filename: str):
-        numpy_weights = []
-        for weight in self.model.weights:
-            numpy_weights.append([weight.name, weight.numpy()])
-        self.net.fill_net_v2(numpy_weights)
-        self.net.save_proto(filename)
+        self.save_leelaz_weights(filename, model=self.swa_model)
+
+    def save_leelaz_weights(self, filename: str, model=None):
+        if model is None:
+            model = self.model
+        self.write_leelaz_weights(self.net, self.read_numpy_weights(model),
+                                  filename)
+
+    @staticmethod
+    def read_numpy_weights(model):
+        return [[weight.name, weight.numpy()] for weight in model.weights]
+
+    @staticmethod
+    def write_leelaz_weights(net, numpy_weights, filename: str):
+        net.fill_net_v2(numpy_weights)
+        net.save_proto(filename)
+
+    def copy_net(self):
+        # Independent Net for a background export, so self.net can keep
+        # changing on the training thread.
+        net = copy.copy(self.net)
+        net.pb = pb.Net()
+        net.pb.CopyFrom(self.net.pb)
+        return net
 
     @staticmethod
     def split_heads(inputs, batch_size: int, num_heads: int, depth: int):
@@ -1975,9 +2500,11 @@ class TFProcess:
 
 
         if self.use_rpe_q:
-            matmul_qk = matmul_qk + RPELogits(name=name+"/rpe_q", rpe_type='q')(q)
+            matmul_qk = matmul_qk + self.to_model_dtype(RPELogits(
+                name=name+"/rpe_q", rpe_type='q', dtype=self.layer_dtype(name+"/rpe_q"))(q))
         if self.use_rpe_k:
-            matmul_qk = matmul_qk + RPELogits(name=name+"/rpe_k", rpe_type='k')(k)
+            matmul_qk = matmul_qk + self.to_model_dtype(RPELogits(
+                name=name+"/rpe_k", rpe_type='k', dtype=self.layer_dtype(name+"/rpe_k"))(k))
 
 
         scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
@@ -2000,7 +2527,8 @@ class TFProcess:
 
         if self.use_rpe_v:
             head_depth = v.shape[-1]
-            output = output + RPEValue(head_depth, name=name+'/rpe_v')(attention_weights)
+            output = output + self.to_model_dtype(RPEValue(
+                head_depth, name=name+'/rpe_v', dtype=self.layer_dtype(name+'/rpe_v'))(attention_weights))
 
         # output shape = (b, h, 64, d)
 
@@ -2030,12 +2558,17 @@ class TFProcess:
             inputs = input_quantize(inputs)
 
 
-        q = DenseLayer(
-            depth, name=name+"/wq", kernel_initializer="glorot_normal", use_bias=use_bias, quantized=self.quantize_weights, n_bits=self.quantize_weight_bits, input_quantize=input_quantize, use_rep_quant=use_rep_quant)(inputs)
-        k = DenseLayer(
-            depth, name=name+"/wk", kernel_initializer="glorot_normal", use_bias=use_bias, quantized=self.quantize_weights, n_bits=self.quantize_weight_bits, input_quantize=input_quantize, use_rep_quant=use_rep_quant)(inputs)
-        v = DenseLayer(
-            depth, name=name+"/wv", kernel_initializer=initializer, use_bias=use_bias, quantized=self.quantize_weights, n_bits=self.quantize_weight_bits, input_quantize=input_quantize, use_rep_quant=use_rep_quant)(inputs)
+        if self.fused_qkv:
+            qkv = DenseLayer(
+                3 * depth, name=name+"/wqkv", kernel_initializer=ConcatInitializer(["glorot_normal", "glorot_normal", initializer]), use_bias=use_bias)(inputs)
+            q, k, v = tf.split(qkv, 3, axis=-1)
+        else:
+            q = DenseLayer(
+                depth, name=name+"/wq", kernel_initializer="glorot_normal", use_bias=use_bias, quantized=self.quantize_weights, n_bits=self.quantize_weight_bits, input_quantize=input_quantize, use_rep_quant=use_rep_quant)(inputs)
+            k = DenseLayer(
+                depth, name=name+"/wk", kernel_initializer="glorot_normal", use_bias=use_bias, quantized=self.quantize_weights, n_bits=self.quantize_weight_bits, input_quantize=input_quantize, use_rep_quant=use_rep_quant)(inputs)
+            v = DenseLayer(
+                depth, name=name+"/wv", kernel_initializer=initializer, use_bias=use_bias, quantized=self.quantize_weights, n_bits=self.quantize_weight_bits, input_quantize=input_quantize, use_rep_quant=use_rep_quant)(inputs)
 
 
         activations[name + "/wq"] = q
@@ -2139,8 +2672,7 @@ class TFProcess:
             self.dropout_rate, name=name + "/dropout1")(attn_output, training=training)
 
         # skip connection + layernorm
-        out1 = self.encoder_norm(
-            name=name+"/ln1")(inputs + attn_output * alpha)
+        out1 = self.apply_norm(inputs + attn_output * alpha, name=name+"/ln1")
         activations[name + "/ln1"] = out1
 
         # feed-forward network
@@ -2151,12 +2683,35 @@ class TFProcess:
         
         activations.update(activations_ffn)
 
-        out2 = self.encoder_norm(
-            name=name+"/ln2")(out1 + ffn_output * alpha)
+        out2 = self.apply_norm(out1 + ffn_output * alpha, name=name+"/ln2")
         activations[name + "/ln2"] = out2
 
         return out2, attn_wts, activations
 
+    def layer_dtype(self, name: str):
+        """dtype for the layer called name, None to use the global policy."""
+        if self.model_dtype != tf.float32 and any(
+                pattern.search(name) for pattern in self.float32_layers):
+            return "float32"
+        return None
+
+    def to_model_dtype(self, x):
+        return x if x.dtype == self.model_dtype else tf.cast(x, self.model_dtype)
+
+    def apply_norm(self, inputs, name: str):
+        return self.to_model_dtype(
+            self.encoder_norm(name=name, dtype=self.layer_dtype(name))(inputs))
+
+    def recompute_block(self, fn, inputs, name: str):
+        # Build fn into its own sub-model so its activations can be recomputed
+        # in the backward pass. Layers are created inside fn, so weight names
+        # are unchanged and protobuf export is unaffected.
+        block_input = tf.keras.Input(shape=inputs.shape[1:], dtype=inputs.dtype)
+        block = tf.keras.Model(inputs=block_input,
+                               outputs=fn(block_input),
+                               name=name + "/block")
+        return RecomputeGrad(block, name=name + "/recompute")(inputs)
+
     def smolgen_weights(self, inputs, heads: int, hidden_channels: int, hidden_sz: int, gen_sz: int, name: str, activation="swish"):
         compressed = tf.keras.layers.Dense(
             hidden_channels, name=name+"/compress", use_bias=False)(inputs)
@@ -2203,8 +2758,7 @@ class TFProcess:
             flow = tf.keras.layers.Dense(self.embedding_size, kernel_initializer="glorot_normal",
                                          activation=self.DEFAULT_ACTIVATION,
                                          name=name+"embedding")(flow)
-            flow = self.encoder_norm(
-                name=name+"embedding/ln")(flow)
+            flow = self.apply_norm(flow, name=name+"embedding/ln")
             flow = ma_gating(flow, name=name+'embedding')
 
             # DeepNorm
@@ -2219,12 +2773,17 @@ class TFProcess:
                 scale=beta, mode="fan_avg", distribution="truncated_normal", seed=42)
 
             # feed-forward network
-            ffn_output, activations = self.ffn(flow, self.embedding_size, self.encoder_dff,
-                                  xavier_norm, name=name + "embedding/ffn")
-
-
-            flow = self.encoder_norm(
-                name=name+"embedding/ffn_ln")(flow + ffn_output * alpha)
+            def embedding_ffn(flow):
+                ffn_output, _ = self.ffn(flow, self.embedding_size, self.encoder_dff,
+                                         xavier_norm, name=name + "embedding/ffn")
+                return self.apply_norm(flow + ffn_output * alpha,
+                                       name=name+"embedding/ffn_ln")
+
+            if self.checkpoint_embedding_ffn:
+                flow = self.recompute_block(
+                    embedding_ffn, flow, name=name + "embedding/ffn")
+            else:
+                flow = embedding_ffn(flow)
 
         elif self.embedding_style == "old":
             flow = tf.transpose(inputs, perm=[0, 2, 3, 1])
@@ -2245,9 +2804,17 @@ class TFProcess:
         attn_wts = []
         activations = {}
         for i in range(self.encoder_layers):
+            layer_name = name + "encoder_{}".format(i + 1)
+            if i + 1 in self.checkpointed_layers:
+                flow = self.recompute_block(
+                    lambda x: self.encoder_layer(x, self.embedding_size, self.encoder_d_model,
+                                                 self.encoder_heads, self.encoder_dff,
+                                                 name=layer_name, training=True)[0],
+                    flow, name=layer_name)
+                continue
             flow, attn_wts_l, activations_l = self.encoder_layer(flow, self.embedding_size, self.encoder_d_model,
                                                   self.encoder_heads, self.encoder_dff,
-                                                  name=name+"encoder_{}".format(i + 1), training=True)
+                                                  name=layer_name, training=True)
 
             attn_wts.append(attn_wts_l)
             activations.update(activations_l)
@@ -2260,6 +2827,21 @@ class TFProcess:
                                               name=name+"policy/embedding")(flow_)
     
 
+        aux_depth = self.cfg['model'].get('policy_d_aux', self.policy_d_model)
+
+        policy_projections = {}
+        if self.policy_shared_projections:
+            heads = [("vanilla", self.policy_d_model)]
+            if self.cfg['model'].get('policy_optimistic_st', False):
+                heads.append(("optimistic_st", self.policy_d_model))
+            if self.cfg['model'].get('soft_policy', False):
+                heads.append(("soft", aux_depth))
+            shared = PolicyProjections(heads, name="policy")(policy_tokens)
+            policy_projections = {
+                "policy/" + head: qk
+                for head, qk in shared.items()
+            }
+
         def policy_head(name, activation=None, depth=None, opponent=False):
             if depth is None:
                 depth = self.policy_d_model
@@ -2269,10 +2851,13 @@ class TFProcess:
                 1]) if opponent else policy_tokens
 
             # create queries and keys for policy self-attention
-            queries = tf.keras.layers.Dense(depth, kernel_initializer="glorot_normal",
-                                            name=name+"/attention/wq")(tokens)
-            keys = tf.keras.layers.Dense(depth, kernel_initializer="glorot_normal",
-                                         name=name+"/attention/wk")(tokens)
+            if name in policy_projections and not opponent:
+                queries, keys = policy_projections[name]
+            else:
+                queries = tf.keras.layers.Dense(depth, kernel_initializer="glorot_normal",
+                                                name=name+"/attention/wq")(tokens)
+                keys = tf.keras.layers.Dense(depth, kernel_initializer="glorot_normal",
+                                             name=name+"/attention/wk")(tokens)
 
             # POLICY SELF-ATTENTION: self-attention weights are interpreted as from->to policy
             # Bx64x64 (from 64 queries, 64 keys)
@@ -2334,9 +2919,6 @@ class TFProcess:
             # hack so checkpointing works
             return tf.keras.layers.Dense(2, name=name+"/attention/wq")(policy_tokens)
 
-
-        aux_depth = self.cfg['model'].get('policy_d_aux', self.policy_d_model)
-
         policy = policy_head(name="policy/vanilla")
 
         policy_optimistic_st = policy_head(
@@ -2352,35 +2934,44 @@ class TFProcess:
         def value_head(name, wdl=True, use_err=True, use_cat=True):
             embedded_val = tf.keras.layers.Dense(self.val_embedding_size, kernel_initializer="glorot_normal",
                                                  activation=self.DEFAULT_ACTIVATION,
-                                                 name=name+"/embedding")(flow)
+                                                 name=name+"/embedding",
+                                                 dtype=self.layer_dtype(name+"/embedding"))(flow)
 
-            h_val_flat = tf.keras.layers.Flatten()(embedded_val)
+            # Same dtype as the embedding so a float32 override isn't cast
+            # back to the compute dtype.
+            h_val_flat = tf.keras.layers.Flatten(
+                dtype=self.layer_dtype(name+"/embedding"))(embedded_val)
             h_fc2 = tf.keras.layers.Dense(128,
                                           kernel_initializer="glorot_normal",
                                           activation=self.DEFAULT_ACTIVATION,
-                                          name=name+"/dense1")(h_val_flat)
+                                          name=name+"/dense1",
+                                          dtype=self.layer_dtype(name+"/dense1"))(h_val_flat)
 
             # WDL head
             if wdl:
                 value = tf.keras.layers.Dense(3,
                                               kernel_initializer="glorot_normal",
-                                              name=name+"/dense2")(h_fc2)
+                                              name=name+"/dense2",
+                                              dtype=self.layer_dtype(name+"/dense2"))(h_fc2)
             else:
                 value = tf.keras.layers.Dense(1,
                                               kernel_initializer="glorot_normal",
                                               activation="tanh",
-                                              name=name+"/dense2")(h_fc2)
+                                              name=name+"/dense2",
+                                              dtype=self.layer_dtype(name+"/dense2"))(h_fc2)
 
             if use_err:
                 # Shouldn't be more than 1
                 value_err = tf.keras.layers.Dense(
-                    1, kernel_initializer="glorot_normal", name=name+"/dense_error", activation="sigmoid")(h_fc2)
+                    1, kernel_initializer="glorot_normal", name=name+"/dense_error", activation="sigmoid",
+                    dtype=self.layer_dtype(name+"/dense_error"))(h_fc2)
             else:
                 value_err = None
 
             if use_cat and self.categorical_value_buckets:
                 value_cat = tf.keras.layers.Dense(
-                    self.categorical_value_buckets, kernel_initializer="glorot_normal", name=name+"/dense_cat")(h_fc2)
+                    self.categorical_value_buckets, kernel_initializer="glorot_normal", name=name+"/dense_cat",
+                    dtype=self.layer_dtype(name+"/dense_cat"))(h_fc2)
             else:
                 value_cat = None
 
@@ -2397,22 +2988,26 @@ class TFProcess:
         if self.moves_left:
             embedded_mov = tf.keras.layers.Dense(self.mov_embedding_size, kernel_initializer="glorot_normal",
                                                  activation=self.DEFAULT_ACTIVATION,
-                                                 name=name+"moves_left/embedding")(flow)
+                                                 name=name+"moves_left/embedding",
+                                                 dtype=self.layer_dtype(name+"moves_left/embedding"))(flow)
 
-            h_mov_flat = tf.keras.layers.Flatten()(embedded_mov)
+            h_mov_flat = tf.keras.layers.Flatten(
+                dtype=self.layer_dtype(name+"moves_left/embedding"))(embedded_mov)
 
             h_fc4 = tf.keras.layers.Dense(
                 128,
                 kernel_initializer="glorot_normal",
                 activation=self.DEFAULT_ACTIVATION,
-                name=name+"moves_left/dense1")(h_mov_flat)
+                name=name+"moves_left/dense1",
+                dtype=self.layer_dtype(name+"moves_left/dense1"))(h_mov_flat)
             
 
 
             moves_left = tf.keras.layers.Dense(1,
                                                kernel_initializer="glorot_normal",
                                                activation="relu",
-                                               name=name+"moves_left/dense2")(h_fc4)
+                                               name=name+"moves_left/dense2",
+                                               dtype=self.layer_dtype(name+"moves_left/dense2"))(h_fc4)
         else:
             moves_left = None
 
@@ -2460,33 +3055,63 @@ class TFProcess:
 
         return outputs
 
-    def set_sparsity_patterns(self):
-        sparsity_patterns = {}
-        for layer in self.model.layers:
-            if isinstance(layer, tf.keras.layers.Dense) and "encoder" in layer.name and "smolgen" not in layer.name:
-                kernel = layer.kernel
-                # 2 out of 4 sparsity pattern
-                in_channels = kernel.shape[0]
-                out_channels = kernel.shape[1]
-
-                kernel_abs = tf.abs(kernel)
-                kernel_abs = tf.reshape(kernel_abs, [-1, 4])
-
-                top_2 = tf.math.top_k(kernel_abs, k=2, sorted=True)
-                second_largest = top_2.values[:, 1:2]
-                comparison = tf.math.greater_equal(kernel_abs, second_largest)
-                comparison = tf.cast(comparison, tf.float32)
-                comparison = tf.reshape(
-                    comparison, [in_channels, out_channels])
-
-                sparsity_patterns[layer.name] = comparison
-
-        self.sparsity_patterns = sparsity_patterns
-
-    def apply_sparsity(self):
-        assert hasattr(self, "sparsity_patterns"), "Sparsity patterns not set"
-        for layer in self.model.layers:
-            if layer.name in self.sparsity_patterns:
-                kernel = layer.kernel
-                kernel.assign(kernel * self.sparsity_patterns[layer.name])
+    @staticmethod
+    def is_sparse_kernel(w):
+        return (len(w.shape) == 2 and "kernel" in w.name
+                and "encoder" in w.name and "smolgen" not in w.name
+                and w.shape[0] % 4 == 0)
+
+    def sparsity_target(self, steps: int):
+        """Fraction of 2:4 groups to prune at steps, on a cubic schedule."""
+        if steps < self.sparsity_start_step:
+            return 0.0
+        if self.sparsity_end_step <= self.sparsity_start_step:
+            return 1.0
+        progress = min(1.0, (steps - self.sparsity_start_step) /
+                       (self.sparsity_end_step - self.sparsity_start_step))
+        return 1.0 - (1.0 - progress)**3
+
+    def maybe_update_sparsity(self, steps: int):
+        target = self.sparsity_target(steps)
+        level = float(self.sparsity_level.numpy())
+        if target <= level:
+            return
+        # Also right away when no masks were restored, and at the end of the
+        # schedule so the final masks are full 2:4.
+        if (steps - self.sparsity_start_step
+            ) % self.sparsity_update_steps == 0 or level == 0 or target == 1.0:
+            self.update_sparsity_masks(tf.constant(target, tf.float32))
+
+    @tf.function()
+    def update_sparsity_masks(self, fraction):
+        for w, mask in zip(self.sparse_weights, self.sparsity_masks):
+            new_mask = nm_sparsity_mask(w, fraction)
+            mask.assign(new_mask)
+            w.assign(w * new_mask)
+        self.sparsity_level.assign(fraction)
+
+    def masks_from_weights(self):
+        """Masks from the zeros of loaded kernels. Nets only store the
+        weights, so the 2:4 pattern is recovered from them; kernels that
+        aren't fully 2:4 sparse keep their masks."""
+        all_sparse = True
+        for w, mask in zip(self.sparse_weights, self.sparsity_masks):
+            kernel = w.numpy()
+            if is_nm_sparse(kernel.T):
+                mask.assign((kernel != 0).astype(kernel.dtype))
+            else:
+                all_sparse = False
+        if all_sparse:
+            self.sparsity_level.assign(1.0)
+
+    def apply_sparsity_masks(self):
+        # Called from apply_grads, in replica context.
+        def apply(strategy):
+            for w, mask in zip(self.sparse_weights, self.sparsity_masks):
+                strategy.extended.update(w,
+                                         lambda w, mask: w.assign(w * mask),
+                                         args=(mask, ),
+                                         group=False)
+
+        tf.distribute.get_replica_context().merge_call(apply)
 
@@ -28,6 +28,7 @@ import itertools
 from chunkparser import ChunkParser
 import random
 import pickle
+import zlib
 
 
 SKIP = 32
@@ -128,6 +129,16 @@ def get_latest_chunks(path, num_chunks, allow_less, sort_key_fn, fast=False):
     return chunks
 
 
+def partition_chunks(chunks, num_parts):
+    """Split chunks into num_parts disjoint lists by a stable hash of the
+    file name."""
+    parts = [[] for _ in range(num_parts)]
+    for chunk in chunks:
+        parts[zlib.crc32(os.path.basename(chunk).encode()) %
+              num_parts].append(chunk)
+    return parts
+
+
 def identity_function(name):
     return name
 
@@ -196,12 +207,40 @@ def main(cmd):
     shuffle_size = cfg["training"]["shuffle_size"]
     total_batch_size = cfg["training"]["batch_size"]
     batch_splits = cfg["training"].get("num_batch_splits", 1)
+    if batch_splits == "auto":
+        # Workers on different hosts could disagree.
+        if cfg.get("cluster") is not None:
+            raise ValueError(
+                "num_batch_splits: auto is not supported with cluster, run autotune.py and set it")
+        from autotune import autotune_batch_splits
+        batch_splits = autotune_batch_splits(cfg, total_batch_size)
     train_workers = cfg["dataset"].get("train_workers", None)
     test_workers = cfg["dataset"].get("test_workers", None)
     if total_batch_size % batch_splits != 0:
         raise ValueError("num_batch_splits must divide batch_size evenly")
     split_batch_size = total_batch_size // batch_splits
 
+    # Multi-worker training: every worker reads a disjoint part of the
+    # chunks and produces its share of each batch.
+    cluster = cfg.get("cluster")
+    input_batch_size = split_batch_size
+    # Before sharding, so all workers agree on the number of test batches.
+    num_test_chunks = len(test_chunks)
+    if cluster is not None:
+        if cmd.task_index is not None:
+            cluster["task_index"] = cmd.task_index
+        num_workers = len(cluster["workers"])
+        if split_batch_size % num_workers != 0:
+            raise ValueError(
+                "The number of workers must divide batch_size / num_batch_splits evenly")
+        if cfg["dataset"].get("train_pipelines", 1) != 1:
+            raise ValueError("train_pipelines is not supported with cluster")
+        train_chunks = partition_chunks(train_chunks,
+                                        num_workers)[cluster["task_index"]]
+        test_chunks = partition_chunks(test_chunks,
+                                       num_workers)[cluster["task_index"]]
+        input_batch_size = split_batch_size // num_workers
+
     diff_focus_min = cfg["training"].get("diff_focus_min", 1)
     diff_focus_slope = cfg["training"].get("diff_focus_slope", 0)
     diff_focus_q_weight = cfg["training"].get("diff_focus_q_weight", 6.0)
@@ -213,30 +252,51 @@ def main(cmd):
     if not os.path.exists(root_dir):
         os.makedirs(root_dir)
 
-    train_parser = ChunkParser(train_chunks,
-                               get_input_mode(cfg),
-                               shuffle_size=shuffle_size,
-                               sample=SKIP,
-                               batch_size=split_batch_size,
-                               diff_focus_min=diff_focus_min,
-                               diff_focus_slope=diff_focus_slope,
-                               diff_focus_q_weight=diff_focus_q_weight,
-                               diff_focus_pol_scale=diff_focus_pol_scale,
-                               pc_min=pc_min,
-                               pc_max=pc_max,
-                               workers=train_workers)
+    # With more than one pipeline, every replica gets its own parser over a
+    # disjoint part of the training chunks. Must match the number of replicas.
+    train_pipelines = cfg["dataset"].get("train_pipelines", 1)
+    if input_batch_size % train_pipelines != 0:
+        raise ValueError(
+            "train_pipelines must divide batch_size / num_batch_splits evenly")
+    if train_pipelines > 1:
+        train_chunk_parts = partition_chunks(train_chunks, train_pipelines)
+        if not all(train_chunk_parts):
+            raise ValueError("Not enough training chunks for {} pipelines".format(
+                train_pipelines))
+        if train_workers is not None:
+            train_workers = max(1, train_workers // train_pipelines)
+    else:
+        train_chunk_parts = [train_chunks]
+    train_parsers = [
+        ChunkParser(part,
+                    get_input_mode(cfg),
+                    shuffle_size=shuffle_size // train_pipelines,
+                    sample=SKIP,
+                    batch_size=input_batch_size // train_pipelines,
+                    diff_focus_min=diff_focus_min,
+                    diff_focus_slope=diff_focus_slope,
+                    diff_focus_q_weight=diff_focus_q_weight,
+                    diff_focus_pol_scale=diff_focus_pol_scale,
+                    pc_min=pc_min,
+                    pc_max=pc_max,
+                    workers=train_workers) for part in train_chunk_parts
+    ]
     test_shuffle_size = int(shuffle_size * (1.0 - train_ratio))
     # no diff focus for test_parser
     test_parser = ChunkParser(test_chunks,
                               get_input_mode(cfg),
                               shuffle_size=test_shuffle_size,
                               sample=SKIP,
-                              batch_size=split_batch_size,
+                              batch_size=input_batch_size,
                             #   pc_min=pc_min,
                             #   pc_max=pc_max,
                               workers=test_workers)
     
     
+    if "input_validation" in cfg["dataset"] and cluster is not None:
+        # Workers would need exactly the same number of validation batches.
+        print("Validation is not supported with multi-worker training")
+        del cfg["dataset"]["input_validation"]
     if "input_validation" in cfg["dataset"]:
         valid_chunks = get_all_chunks(cfg["dataset"]["input_validation"], fast=fast_chunk_loading)
         validation_parser = ChunkParser(valid_chunks,
@@ -257,34 +317,61 @@ def main(cmd):
     output_types = 9 * (tf.string,)
 
     print("Initializing datasets")
-    train_dataset = tf.data.Dataset.from_generator(
-        train_parser.parse,
-        output_types=output_types)
-    train_dataset = train_dataset.map(parse_function)
-    test_dataset = tf.data.Dataset.from_generator(
-        test_parser.parse,
-        output_types=output_types)
-    test_dataset = test_dataset.map(parse_function)
-
     validation_dataset = None
-    if "input_validation" in cfg["dataset"]:
-        validation_dataset = tf.data.Dataset.from_generator(
-            validation_parser.sequential,
-            output_types=output_types)
-        validation_dataset = validation_dataset.map(parse_function)
-
-    if tfprocess.strategy is None:  # Mirrored strategy appends prefetch itself with a value depending on number of replicas
-        train_dataset = train_dataset.prefetch(4)
-        test_dataset = test_dataset.prefetch(4)
-        if validation_dataset is not None:
-            validation_dataset = validation_dataset.prefetch(4)
+    if cluster is not None:
+        # Each worker reads its own chunks and splits its batches between
+        # its local replicas.
+        def worker_dataset(parser):
+            def dataset_fn(input_context):
+                dataset = tf.data.Dataset.from_generator(
+                    parser.parse, output_types=output_types)
+                dataset = dataset.map(parse_function)
+                dataset = dataset.rebatch(
+                    input_context.get_per_replica_batch_size(split_batch_size))
+                return dataset.prefetch(4)
+            return dataset_fn
+
+        train_dataset = worker_dataset(train_parsers[0])
+        test_dataset = worker_dataset(test_parser)
     else:
-        options = tf.data.Options()
-        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
-        train_dataset = train_dataset.with_options(options)
-        test_dataset = test_dataset.with_options(options)
-        if validation_dataset is not None:
-            validation_dataset = validation_dataset.with_options(options)
+        if train_pipelines > 1:
+            if tfprocess.strategy is None or tfprocess.strategy.num_replicas_in_sync != train_pipelines:
+                raise ValueError("train_pipelines must equal the number of replicas")
+
+            def train_dataset(input_context):
+                parser = train_parsers[input_context.input_pipeline_id]
+                dataset = tf.data.Dataset.from_generator(
+                    parser.parse, output_types=output_types)
+                return dataset.map(parse_function).prefetch(4)
+        else:
+            train_dataset = tf.data.Dataset.from_generator(
+                train_parsers[0].parse,
+                output_types=output_types)
+            train_dataset = train_dataset.map(parse_function)
+        test_dataset = tf.data.Dataset.from_generator(
+            test_parser.parse,
+            output_types=output_types)
+        test_dataset = test_dataset.map(parse_function)
+
+        if "input_validation" in cfg["dataset"]:
+            validation_dataset = tf.data.Dataset.from_generator(
+                validation_parser.sequential,
+                output_types=output_types)
+            validation_dataset = validation_dataset.map(parse_function)
+
+        if tfprocess.strategy is None:  # Mirrored strategy appends prefetch itself with a value depending on number of replicas
+            train_dataset = train_dataset.prefetch(4)
+            test_dataset = test_dataset.prefetch(4)
+            if validation_dataset is not None:
+                validation_dataset = validation_dataset.prefetch(4)
+        else:
+            options = tf.data.Options()
+            options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+            if train_pipelines == 1:
+                train_dataset = train_dataset.with_options(options)
+            test_dataset = test_dataset.with_options(options)
+            if validation_dataset is not None:
+                validation_dataset = validation_dataset.with_options(options)
     print("Done")
 
     print("Initializing TFProcess")
@@ -300,21 +387,23 @@ def main(cmd):
     # For simplicity, testing can use the split batch size instead of total batch size.
     # This does not affect results, because test results are simple averages that are independent of batch size.
     num_evals = cfg["training"].get("num_test_positions",
-                                    len(test_chunks) * 10)
+                                    num_test_chunks * 10)
     num_evals = max(1, num_evals // split_batch_size)
     print("Using {} evaluation batches".format(num_evals))
     tfprocess.total_batch_size = total_batch_size
+    tfprocess.train_parsers = train_parsers
     tfprocess.process_loop(total_batch_size,
                            num_evals,
                            batch_splits=batch_splits)
 
-    if cmd.output is not None:
+    if cmd.output is not None and tfprocess.is_chief:
         if cfg["training"].get("swa_output", False):
             tfprocess.save_swa_weights(cmd.output)
         else:
             tfprocess.save_leelaz_weights(cmd.output)
 
-    train_parser.shutdown()
+    for train_parser in train_parsers:
+        train_parser.shutdown()
     test_parser.shutdown()
 
 
@@ -327,6 +416,9 @@ if __name__ == "__main__":
     argparser.add_argument("--output",
                            type=str,
                            help="file to store weights in")
+    argparser.add_argument("--task-index",
+                           type=int,
+                           help="index of this worker in cluster.workers")
 
     # mp.set_start_method("spawn")
     main(argparser.parse_args())